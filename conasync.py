@@ -0,0 +1,408 @@
+##
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Stefan Wendler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+##
+
+"""
+asyncio connections to a board, the counterparts of ConSerial, ConTelnet and ConWebsock.
+
+Received bytes are pushed into a buffer by the event loop as they arrive, readers wait on it
+instead of polling inWaiting(), so one loop serves many boards.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import struct
+import sys
+import threading
+
+from conbase import ConError
+
+
+class AsyncConBase:
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._received = asyncio.Event()
+        self._closed = False
+
+    def _feed(self, data):
+        """called in the event loop with the bytes received"""
+        if data:
+            self._buffer += data
+            self._received.set()
+
+    def _feed_eof(self):
+        self._closed = True
+        self._received.set()
+
+    async def _wait_data(self, timeout):
+        self._received.clear()
+        await asyncio.wait_for(self._received.wait(), timeout)
+
+    async def read(self, size=1, timeout=10):
+        """
+        Returns:
+            size bytes, fewer if the timeout passed or the connection closed first
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while len(self._buffer) < size and not self._closed:
+            remain = None if deadline is None else deadline - loop.time()
+            if remain is not None and remain <= 0:
+                break
+            try:
+                await self._wait_data(remain)
+            except asyncio.TimeoutError:
+                break
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def read_until(self, ending, timeout=10, max_recv=sys.maxsize, data_consumer=None):
+        """
+        read until ending is received, the timeout restarts with every received byte like Pyboard.read_until
+        Returns:
+            the bytes read, not ending with ending on timeout or after max_recv bytes
+        """
+        start = 0
+        while True:
+            index = self._buffer.find(ending, start)
+            if index >= 0:
+                size = index + len(ending)
+            elif len(self._buffer) >= max_recv or self._closed:
+                size = min(len(self._buffer), max_recv)
+            else:
+                start = max(0, len(self._buffer) - len(ending) + 1)
+                try:
+                    await self._wait_data(timeout)
+                except asyncio.TimeoutError:
+                    size = len(self._buffer)
+                else:
+                    continue
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            if data_consumer:
+                data_consumer(data)
+            return data
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    async def write(self, data):
+        raise NotImplementedError()
+
+    async def close(self):
+        raise NotImplementedError()
+
+    def survives_soft_reset(self):
+        return False
+
+
+class AsyncConSerial(AsyncConBase):
+    """
+    serial port read by the event loop through add_reader on POSIX. Where the loop can't watch the
+    port (Windows), a reader thread hands the bytes to the loop
+    """
+
+    def __init__(self, port, baudrate=115200):
+        AsyncConBase.__init__(self)
+        self.port = port
+        self.baudrate = baudrate
+        self.serial = None
+        self._thread = None
+
+    async def open(self):
+        from serial import Serial
+
+        loop = asyncio.get_running_loop()
+        try:
+            self.serial = Serial(baudrate=self.baudrate, timeout=0)
+            self.serial.port = self.port
+            self.serial.dtr = self.serial.rts = False
+            self.serial.open()
+        except Exception as e:
+            logging.error(e)
+            raise ConError(e)
+
+        try:
+            loop.add_reader(self.serial.fileno(), self._on_readable)
+        except (AttributeError, NotImplementedError, ValueError):
+            self.serial.timeout = 0.1
+            self._thread = threading.Thread(target=self._read_thread, args=(loop,), daemon=True,
+                                            name=f'mpf-serial-{self.port}')
+            self._thread.start()
+        logging.info(f'async serial connected to {self.port}')
+        return self
+
+    def _on_readable(self):
+        try:
+            self._feed(self.serial.read(self.serial.in_waiting or 1))
+        except Exception as e:
+            logging.error(f'serial read failed: {e}')
+            asyncio.get_running_loop().remove_reader(self.serial.fileno())
+            self._feed_eof()
+
+    def _read_thread(self, loop):
+        while not self._closed:
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except Exception as e:
+                logging.error(f'serial read failed: {e}')
+                loop.call_soon_threadsafe(self._feed_eof)
+                return
+            if data:
+                loop.call_soon_threadsafe(self._feed, data)
+
+    async def write(self, data):
+        # pyserial writes block until the OS buffer takes the data, keep the loop free meanwhile
+        return await asyncio.get_running_loop().run_in_executor(None, self.serial.write, data)
+
+    async def close(self):
+        if self.serial is None:
+            return
+        if self._thread is None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.serial.fileno())
+            except (AttributeError, NotImplementedError, ValueError):
+                pass
+        self._closed = True
+        self.serial.close()
+
+
+class AsyncConTelnet(AsyncConBase):
+    """telnet REPL of the board, option negotiation is refused"""
+    IAC, DONT, DO, WONT, WILL, SB, SE = 255, 254, 253, 252, 251, 250, 240
+
+    def __init__(self, ip, user, password, port=23):
+        AsyncConBase.__init__(self)
+        self.ip = ip
+        self.user = user
+        self.password = password
+        self.telnet_port = port
+        self._writer = None
+        self._task = None
+        self._pending = b''  # unfinished telnet command at the end of the last read
+
+    async def open(self):
+        try:
+            reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.telnet_port), 10)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConError(e)
+        self._task = asyncio.ensure_future(self._pump(reader))
+
+        if self.user != '':
+            if not (await self.read_until(b'Login as:', timeout=5)).endswith(b'Login as:'):
+                raise ConError('no login prompt')
+            await self.write(self.user.encode('ascii') + b'\r\n')
+            if not (await self.read_until(b'Password:', timeout=5)).endswith(b'Password:'):
+                raise ConError('no password prompt')
+            # needed because of internal implementation details of the telnet server
+            await asyncio.sleep(0.2)
+            await self.write(self.password.encode('ascii') + b'\r\n')
+            banner = b'Type "help()" for more information.'
+            if not (await self.read_until(banner, timeout=5)).endswith(banner):
+                raise ConError('telnet login failed')
+        logging.info(f'async telnet connected to {self.ip}')
+        return self
+
+    async def _pump(self, reader):
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                self._feed(self._strip_commands(data))
+        except (OSError, asyncio.CancelledError):
+            pass
+        self._feed_eof()
+
+    def _strip_commands(self, data):
+        data = self._pending + data
+        self._pending = b''
+        out = bytearray()
+        i = 0
+        while i < len(data):
+            byte = data[i]
+            if byte != self.IAC:
+                out.append(byte)
+                i += 1
+                continue
+            if i + 1 >= len(data):
+                self._pending = data[i:]
+                break
+            command = data[i + 1]
+            if command == self.IAC:
+                out.append(self.IAC)
+                i += 2
+            elif command in (self.DO, self.DONT, self.WILL, self.WONT):
+                if i + 2 >= len(data):
+                    self._pending = data[i:]
+                    break
+                option = data[i + 2]
+                if command == self.DO:
+                    self._writer.write(bytes((self.IAC, self.WONT, option)))
+                elif command == self.WILL:
+                    self._writer.write(bytes((self.IAC, self.DONT, option)))
+                i += 3
+            elif command == self.SB:
+                end = data.find(bytes((self.IAC, self.SE)), i)
+                if end < 0:
+                    self._pending = data[i:]
+                    break
+                i = end + 2
+            else:
+                i += 2
+        return bytes(out)
+
+    async def write(self, data):
+        self._writer.write(data.replace(bytes((self.IAC,)), bytes((self.IAC, self.IAC))))
+        await self._writer.drain()
+        return len(data)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+class AsyncConWebsock(AsyncConBase):
+    """
+    WebREPL of the board. The websocket client is a minimal RFC 6455 one on asyncio streams,
+    the REPL only needs unfragmented text and binary frames
+    """
+    OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x1, 0x2, 0x8, 0x9, 0xa
+
+    def __init__(self, ip, password, port=8266):
+        AsyncConBase.__init__(self)
+        self.ip = ip
+        self.password = password
+        self.ws_port = port
+        self._reader = None
+        self._writer = None
+        self._task = None
+
+    async def open(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, self.ws_port), 10)
+            key = base64.b64encode(os.urandom(16)).decode('ascii')
+            self._writer.write(('GET / HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                                'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n'
+                                % (self.ip, self.ws_port, key)).encode('ascii'))
+            response = await asyncio.wait_for(self._reader.readuntil(b'\r\n\r\n'), 10)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            print("\nWebREPL Remote IP does not respond, check belong to the same network.")
+            raise ConError(e)
+        if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+            raise ConError(f'websocket handshake failed: {response[:64]}')
+        self._task = asyncio.ensure_future(self._pump())
+
+        if not (await self.read_until(b'Password:', timeout=10)).endswith(b'Password:'):
+            print("\nWebREPL Remote IP does not respond, check belong to the same network.")
+            raise ConError('no password prompt')
+        await self._send(self.OP_TEXT, (self.password + '\r').encode('utf-8'))
+        if not (await self.read_until(b'WebREPL connected', timeout=5)).endswith(b'WebREPL connected'):
+            print("\nWebREPL Password Error")
+            raise ConError('wrong password')
+        logging.info("async websocket connected to ws://%s:%d" % (self.ip, self.ws_port))
+        return self
+
+    async def _pump(self):
+        try:
+            while True:
+                head = await self._reader.readexactly(2)
+                opcode, length = head[0] & 0x0f, head[1] & 0x7f
+                if length == 126:
+                    length = struct.unpack('>H', await self._reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack('>Q', await self._reader.readexactly(8))[0]
+                mask = await self._reader.readexactly(4) if head[1] & 0x80 else None
+                payload = await self._reader.readexactly(length)
+                if mask:
+                    payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+                if opcode in (self.OP_TEXT, self.OP_BINARY, 0x0):
+                    self._feed(payload)
+                elif opcode == self.OP_PING:
+                    await self._send(self.OP_PONG, payload)
+                elif opcode == self.OP_CLOSE:
+                    break
+        except (OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        self._feed_eof()
+
+    async def _send(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack('>BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            head = struct.pack('>BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            head = struct.pack('>BBQ', 0x80 | opcode, 0x80 | 127, length)
+        mask = os.urandom(4)
+        self._writer.write(head + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+        await self._writer.drain()
+
+    async def write(self, data):
+        await self._send(self.OP_TEXT, data)
+        return len(data)
+
+    async def close(self):
+        if self._writer is not None:
+            try:
+                await self._send(self.OP_CLOSE, b'')
+            except OSError:
+                pass
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
+
+
+async def open_connection(constr):
+    """
+    Args:
+        constr: connection string of MpFileExplorer, ser:<port>[,<baudrate>], tn:<ip>,<login>,<passwd>
+                or ws:<ip>,<passwd>. Login and passwords are not asked for, they must be given
+
+    Returns:
+        connected AsyncConBase
+
+    """
+    proto, target = constr.split(":", 1)
+    params = [param.strip(" ") for param in target.split(",")]
+    proto = proto.strip(" ")
+    if proto == "ser":
+        baudrate = int(params[1]) if len(params) > 1 else 115200
+        return await AsyncConSerial(params[0], baudrate).open()
+    elif proto == "tn":
+        if len(params) < 3:
+            raise ConError('telnet needs tn:<ip>,<login>,<passwd>')
+        return await AsyncConTelnet(params[0], params[1], params[2]).open()
+    elif proto == "ws":
+        if len(params) < 2:
+            raise ConError('websocket needs ws:<ip>,<passwd>')
+        return await AsyncConWebsock(params[0], params[1]).open()
+    raise ConError(f'Unknown connection: {constr}')
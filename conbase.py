@@ -22,6 +22,9 @@
 # THE SOFTWARE.
 ##
 
+import sys
+import time
+
 
 class ConError(Exception):
     pass
@@ -30,7 +33,9 @@ class ConError(Exception):
 class ConBase:
 
     def __init__(self):
-        pass
+        # bytes written and read so far, for the throughput report of fleet
+        self.tx = 0
+        self.rx = 0
 
     def close(self):
         raise NotImplemented()
@@ -44,6 +49,38 @@ class ConBase:
     def inWaiting(self):
         raise NotImplemented()
 
+    def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None, max_recv=sys.maxsize,
+                   keep_data=True):
+        """
+        read until ending is received, polling inWaiting. The timeout restarts with every received byte
+        Args:
+            keep_data: False to hand the data only to data_consumer, and return just the tail containing ending
+        """
+
+        data = bytearray(self.read(min_num_bytes))
+        if data_consumer:
+            data_consumer(bytes(data))
+        timeout_count = 0
+        while len(data) < max_recv:
+            # print(len(data), data) # if main.py exist "while True:\r\nprint(1)\r\n lead to recv data error"
+
+            if data.endswith(ending):
+                break
+            elif self.inWaiting() > 0:
+                new_data = self.read(1)
+                data += new_data
+                if data_consumer:
+                    data_consumer(new_data)
+                    if not keep_data:
+                        del data[:-len(ending)]
+                timeout_count = 0
+            else:
+                timeout_count += 1
+                if timeout is not None and timeout_count >= 100 * timeout:
+                    break
+                time.sleep(0.01)
+        return bytes(data)
+
     @property
     def in_waiting(self):
         return self.inWaiting()
@@ -22,20 +22,36 @@
 # THE SOFTWARE.
 ##
 
+import sys
 import time
 import logging
+import threading
 
 from serial import Serial
 from conbase import ConBase, ConError
+from utility.utils import RingBuffer
 
 
 class ConSerial(ConBase):
-
-    def __init__(self, port, baudrate=115200, reset=False):
+    """
+    A reader thread moves everything the port receives into a ring buffer, read and read_until
+    wait on a condition for it instead of polling the port
+    """
+    RX_BUFFER = 64 * 1024
+    POLL_TIMEOUT = 0.1  # port read timeout, how soon the reader thread notices close
+    INTER_BYTE_TIMEOUT = 1  # read returns early once data stopped arriving for this long
+
+    def __init__(self, port, baudrate=115200, reset=False, exclusive=None):
+        """
+        Args:
+            exclusive: True to fail if another program holds an exclusive lock on the port, None for
+                the platform default. The lock is advisory on POSIX, programs that do not ask for it
+                still open the port
+        """
         ConBase.__init__(self)
 
         try:
-            self.serial = Serial(baudrate=baudrate, interCharTimeout=1)
+            self.serial = Serial(baudrate=baudrate, interCharTimeout=1, exclusive=exclusive)
 
             self.serial.port = port
             self.serial.dtr = self.serial.rts = False
@@ -49,33 +65,156 @@ class ConSerial(ConBase):
                 self.serial.setDTR(False)
 
                 self.serial.close()
-                self.serial = Serial(port, baudrate=baudrate, interCharTimeout=1)
+                self.serial = Serial(port, baudrate=baudrate, interCharTimeout=1, exclusive=exclusive)
 
                 while True:
                     time.sleep(2.0)
-                    if not self.inWaiting():
+                    if not self.serial.inWaiting():
                         break
-                    self.serial.read(self.inWaiting())
+                    self.serial.read(self.serial.inWaiting())
+
+            self.serial.timeout = self.POLL_TIMEOUT
 
         except Exception as e:
             logging.error(e)
             raise ConError(e)
 
+        self._ring = RingBuffer(self.RX_BUFFER)
+        self._ready = threading.Condition()
+        self._closed = False
+        self._cancelled = False
+        self._error = None
+        self._reader = threading.Thread(target=self._read_loop, name='mpf-serial-reader', daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        while not self._closed:
+            try:
+                data = self.serial.read(self.serial.inWaiting() or 1)
+            except Exception as e:
+                with self._ready:
+                    if not self._closed:
+                        logging.error(e)
+                        self._error = e
+                    self._ready.notify_all()
+                return
+            if not data:
+                continue
+            logging.debug("serial read < %s" % str(data))
+
+            data = memoryview(data)
+            with self._ready:
+                while data and not self._closed:
+                    data = data[self._ring.write(data):]
+                    self._ready.notify_all()
+                    if data:
+                        # the port buffers the rest until a reader makes room
+                        self._ready.wait()
+
     def close(self):
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+        if self._reader is not threading.current_thread():
+            self._reader.join()
         return self.serial.close()
 
+    def cancel_read(self):
+        """make a blocked read return now, used by the repl terminal to stop its receiver"""
+        with self._ready:
+            self._cancelled = True
+            self._ready.notify_all()
+
+    def reset_cancel(self):
+        """forget a cancel_read no read has seen, once the reader it was meant for has stopped"""
+        with self._ready:
+            self._cancelled = False
+
+    def _check_error(self):
+        if self._error is not None:
+            raise ConError(self._error)
+
     def read(self, size):
         logging.debug(f"serial read size: {size}")
-        data = self.serial.read(size)
-        logging.debug("serial read < %s" % str(data))
-        return data
+        data = bytearray()
+        last = time.time()
+        with self._ready:
+            while len(data) < size:
+                chunk = self._ring.take(size - len(data))
+                if chunk:
+                    data += chunk
+                    self.rx += len(chunk)
+                    last = time.time()
+                    self._ready.notify_all()
+                    continue
+                if self._cancelled or self._closed:
+                    self._cancelled = False
+                    break
+                if self._error is not None:
+                    if data:
+                        break
+                    self._check_error()
+                # like the port before: wait for the first byte, then until data stops arriving
+                remain = self.INTER_BYTE_TIMEOUT - (time.time() - last) if data else None
+                if remain is not None and remain <= 0:
+                    break
+                self._ready.wait(remain)
+        return bytes(data)
+
+    def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None, max_recv=sys.maxsize,
+                   keep_data=True):
+        """
+        read until ending is received, the timeout restarts with every received byte. The bytes scanned
+        without a match are taken from the ring at once, only a tail that may begin ending stays there,
+        so every received byte is searched about once
+        Args:
+            keep_data: False to hand the data only to data_consumer, and return just the tail containing ending
+        """
+
+        data = bytearray()
+        received = 0
+        done = False
+        while not done and received < max_recv:
+            with self._ready:
+                last = time.time()
+                while True:
+                    # the ending may finish at min_num_bytes at the earliest
+                    index = self._ring.find(ending, max(0, min_num_bytes - received - len(ending)))
+                    size = index + len(ending) if index >= 0 else len(self._ring) - len(ending) + 1
+                    done = index >= 0
+                    if size > 0:
+                        break
+                    remain = None if timeout is None else timeout - (time.time() - last)
+                    if self._closed or self._error is not None or (remain is not None and remain <= 0):
+                        # give up, with what was received
+                        if self._error is not None and not received and not self._ring:
+                            self._check_error()
+                        size = len(self._ring)
+                        done = True
+                        break
+                    pending = len(self._ring)
+                    self._ready.wait(remain)
+                    if len(self._ring) != pending:
+                        last = time.time()
+                chunk = self._ring.take(min(size, max_recv - received))
+                self._ready.notify_all()
+            received += len(chunk)
+            self.rx += len(chunk)
+            if data_consumer and chunk:
+                data_consumer(chunk)
+            data += chunk
+            if not keep_data:
+                del data[:-len(ending)]
+        return bytes(data)
 
     def write(self, data):
         logging.debug("serial write > %s" % str(data))
+        self.tx += len(data)
         return self.serial.write(data)
 
     def inWaiting(self):
-        return self.serial.inWaiting()
+        with self._ready:
+            return len(self._ring)
 
     def survives_soft_reset(self):
         return False
@@ -93,6 +93,7 @@ class ConTelnet(ConBase):
         while len(data) < size and len(self.fifo) > 0:
             data += self.fifo.popleft()
 
+        self.rx += len(data)
         return data
 
     def __read3(self, size=1):
@@ -103,12 +104,14 @@ class ConTelnet(ConBase):
         while len(data) < size and len(self.fifo) > 0:
             data += bytes([self.fifo.popleft()])
 
+        self.rx += len(data)
         return data
 
     def write(self, data):
 
         # print("write:", data)
         self.tn.write(data)
+        self.tx += len(data)
         return len(data)
 
     def inWaiting(self):
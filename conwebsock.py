@@ -126,11 +126,13 @@ class ConWebsock(ConBase, threading.Thread):
             elif blocking:
                 self.fifo_lock.acquire()
 
+        self.rx += len(data)
         return data.encode("utf-8")
 
     def write(self, data):
 
         self.ws.send(data)
+        self.tx += len(data)
         return len(data)
 
     def inWaiting(self):
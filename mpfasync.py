@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio variants of Pyboard and of the main MpFileExplorer operations, on the connections of
+conasync.py. AsyncPyboard runs the same pyboard.RawRepl protocol steps as Pyboard, the explorer
+defines the same helpers on the board (utility/listing.py, utility/hashing.py), so one event loop
+can drive many boards:
+
+    async def main():
+        boards = await asyncio.gather(*(AsyncMpFileExplorer.connect(c) for c in constrs))
+        print(await asyncio.gather(*(board.list_dir('/') for board in boards)))
+
+Paths are absolute, there is no current directory, board profiles, transfer agent or resume.
+"""
+
+import asyncio
+import logging
+import posixpath
+
+from conasync import AsyncConSerial, open_connection
+from mpfexp import MpFileExplorer, RemoteIOError, _was_file_not_existing
+from pyboard import PyboardError, RawRepl, Read, ReadUntil, Write, InWaiting
+from utility.codec import select_codecs
+from utility.hashing import HASH_SOURCE
+from utility.listing import LIST_SOURCE, parse_listing, parse_walk_line, parse_removed
+from utility.utils import ChunkSizer
+
+
+class AsyncPyboard:
+    """runs the RawRepl protocol steps of Pyboard on an asyncio connection"""
+
+    def __init__(self, con):
+        logging.info('Init AsyncPyboard')
+
+        self.con = con
+        self.repl = RawRepl()
+
+    @property
+    def use_raw_paste(self):
+        return self.repl.use_raw_paste
+
+    async def close(self):
+
+        if self.con is not None:
+            await self.con.close()
+
+    async def _run(self, step):
+        """run a RawRepl step on the connection, returns its result"""
+        try:
+            request = next(step)
+            while True:
+                if isinstance(request, ReadUntil):
+                    # the buffer of the connection keeps the data anyway, keep_data does not apply
+                    result = await self.read_until(request.ending, timeout=request.timeout,
+                                                   data_consumer=request.data_consumer, max_recv=request.max_recv)
+                elif isinstance(request, Read):
+                    result = await self.con.read(request.size)
+                elif isinstance(request, Write):
+                    result = await self.con.write(request.data)
+                elif isinstance(request, InWaiting):
+                    result = self.con.in_waiting
+                else:
+                    result = await asyncio.sleep(request.seconds)
+                request = step.send(result)
+        except StopIteration as e:
+            return e.value
+
+    async def read_until(self, ending, timeout=10, data_consumer=None, max_recv=8000):
+        return await self.con.read_until(ending, timeout=timeout, max_recv=max_recv, data_consumer=data_consumer)
+
+    async def enter_raw_repl(self):
+        await self._run(self.repl.enter())
+
+    async def exit_raw_repl(self):
+        await self.con.write(b'\r\x02')  # ctrl-B: enter friendly REPL
+
+    async def follow(self, timeout, data_consumer=None):
+        return await self._run(self.repl.follow(timeout, data_consumer))
+
+    async def exec_raw_no_follow(self, command):
+        await self._run(self.repl.exec_raw_no_follow(command))
+
+    async def exec_raw(self, command, timeout=4, data_consumer=None):
+        return await self._run(self.repl.exec_raw(command, timeout, data_consumer))
+
+    async def exec_(self, command):
+        logging.debug(f'execute command {command}')
+        ret, ret_err = await self.exec_raw(command)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+        return ret
+
+    async def eval(self, expression):
+        return (await self.exec_('print({})'.format(expression))).strip()
+
+    async def exec_pipelined(self, commands, window=4, timeout=4, on_result=None):
+        """see RawRepl.exec_pipelined"""
+        return await self._run(self.repl.exec_pipelined(commands, window, timeout, on_result))
+
+
+class AsyncMpFileExplorer(AsyncPyboard):
+
+    PIPELINE_WINDOW = MpFileExplorer.PIPELINE_WINDOW
+    HASH_BATCH = MpFileExplorer.HASH_BATCH
+
+    def __init__(self, con):
+        AsyncPyboard.__init__(self, con)
+        self.sysname = None
+        self.pipeline_window = 1
+        self.chunk_sizer = ChunkSizer(MpFileExplorer.BIN_CHUNK_SIZE)
+        self._write_codec, self._read_codec = select_codecs(has_base64=False)
+        self._remote_hash = False
+        self._lock = asyncio.Lock()  # one exchange at a time on the connection
+
+    @classmethod
+    async def connect(cls, constr):
+        """
+        Args:
+            constr: connection string, see conasync.open_connection
+
+        Returns:
+            AsyncMpFileExplorer in the raw REPL with the helpers defined
+        """
+        explorer = cls(await open_connection(constr))
+        try:
+            await explorer.setup()
+        except BaseException:
+            await explorer.close()
+            raise
+        return explorer
+
+    async def setup(self):
+        await self.enter_raw_repl()
+        await self.exec_("import sys, ubinascii\r\ntry:\r\n    import uos as os\r\nexcept ImportError:\r\n    import os")
+        self.sysname = (await self.eval("os.uname()[0]")).decode('utf-8')
+
+        try:
+            has_base64 = await self.eval("hasattr(ubinascii, 'a2b_base64') and hasattr(ubinascii, 'b2a_base64')")
+        except PyboardError as e:
+            logging.error(e)
+            has_base64 = b''
+        self._write_codec, self._read_codec = select_codecs(has_base64 == b'True')
+        try:
+            await self.exec_("import gc\r\ngc.collect()")
+            mem_free = int(await self.eval("gc.mem_free()"))
+        except (PyboardError, ValueError):
+            mem_free = None
+        self.chunk_sizer = ChunkSizer(self.chunk_sizer.size, mem_free)
+
+        await self.exec_(LIST_SOURCE)
+        try:
+            await self.exec_(HASH_SOURCE)
+            self._remote_hash = True
+        except PyboardError as e:
+            logging.info(f'No sha256 on board, remote_digests is not available: {e}')
+        # only serial input buffers overflow with several commands in flight
+        self.pipeline_window = 1 if isinstance(self.con, AsyncConSerial) else self.PIPELINE_WINDOW
+
+    async def close(self):
+        try:
+            await self.exit_raw_repl()
+        except Exception:
+            pass
+        await AsyncPyboard.close(self)
+
+    async def list_dir(self, path='/'):
+        """[(name, 'D' or 'F', size)] of remote folder path"""
+        async with self._lock:
+            try:
+                return parse_listing(await self.exec_("_mpf_ls('%s')" % path))
+            except PyboardError as e:
+                if _was_file_not_existing(e):
+                    raise RemoteIOError("No such directory: %s" % path)
+                raise e
+
+    async def walk(self, path='/'):
+        """[(path, 'D' or 'F', size, mtime)] of path and every node below it, folders first"""
+        async with self._lock:
+            try:
+                ret = await self.exec_("_mpf_walk('%s')" % path)
+            except PyboardError as e:
+                if _was_file_not_existing(e):
+                    raise RemoteIOError("No such file or directory: %s" % path)
+                raise e
+        return [node for node in map(parse_walk_line, ret.splitlines(True)) if node]
+
+    async def md(self, path):
+        async with self._lock:
+            try:
+                await self.exec_("os.mkdir('%s')" % path)
+            except PyboardError as e:
+                if 'EEXIST' not in str(e) and 'Errno 17' not in str(e):
+                    raise e
+
+    async def rm(self, path):
+        async with self._lock:
+            try:
+                await self.exec_("os.remove('%s')" % path)
+            except PyboardError as e:
+                if _was_file_not_existing(e):
+                    raise RemoteIOError("No such file or directory: %s" % path)
+                raise e
+
+    async def rmrf(self, path):
+        """remove path and everything below it, returns [(path, 'D' or 'F')] removed"""
+        async with self._lock:
+            ret, ret_err = await self.exec_raw("_mpf_rmrf('%s')" % path)
+        if ret_err:
+            if _was_file_not_existing(ret_err):
+                raise RemoteIOError("No such file or directory: %s" % path)
+            raise PyboardError('exception', ret, ret_err)
+        return parse_removed(ret)
+
+    async def get(self, path) -> bytes:
+        """content of remote file path"""
+        decoder = self._read_codec.decoder()
+        chunks = []
+
+        def data_consumer(data):
+            chunk = decoder.feed(data.rstrip(b'\x04') if data.endswith(b'\x04') else data)
+            if chunk:
+                chunks.append(chunk)
+
+        async with self._lock:
+            try:
+                await self.exec_("f = open('%s', 'rb')" % path)
+            except PyboardError as e:
+                if _was_file_not_existing(e):
+                    raise RemoteIOError("Failed to read file: %s" % path)
+                raise e
+            try:
+                ret, ret_err = await self.exec_raw(
+                    "while True:\r\n"
+                    "  c = f.read(%s)\r\n"
+                    "  if not len(c):\r\n"
+                    "    break\r\n"
+                    "  sys.stdout.write(%s)\r\n" % (self.chunk_sizer.size, self._read_codec.remote_encode('c')),
+                    data_consumer=data_consumer)
+            finally:
+                await self.exec_("f.close()")
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+        chunks.append(decoder.flush())
+        return b''.join(chunks)
+
+    async def put(self, path, data: bytes):
+        """write data to remote file path, up to pipeline_window chunks in flight"""
+        size = self.chunk_sizer.size
+        commands = ("f.write(%s)" % self._write_codec.encode(data[offset:offset + size])
+                    for offset in range(0, len(data), size))
+        async with self._lock:
+            try:
+                await self.exec_("f = open('%s', 'wb')" % path)
+            except PyboardError as e:
+                if _was_file_not_existing(e):
+                    raise RemoteIOError("Failed to create file: %s" % path)
+                raise e
+            try:
+                await self.exec_pipelined(commands, window=self.pipeline_window)
+            finally:
+                await self.exec_("f.close()")
+
+    async def remote_digests(self, paths) -> dict:
+        """{path: sha256 hex, None if the file does not exist}, HASH_BATCH paths per exec"""
+        if not self._remote_hash:
+            raise PyboardError('no sha256 on board')
+        paths = list(paths)
+        digests = {}
+
+        def on_result(index, ret):
+            for line in ret.decode('utf-8').splitlines():
+                digest, _, path = line.partition(' ')
+                if path:
+                    digests[path] = None if digest == '-' else digest
+
+        commands = ("_mpf_shas(%r)" % (paths[start:start + self.HASH_BATCH],)
+                    for start in range(0, len(paths), self.HASH_BATCH))
+        async with self._lock:
+            await self.exec_pipelined(commands, window=self.pipeline_window, on_result=on_result)
+        return digests
+
+    async def put_tree(self, src_files, dst):
+        """
+        Args:
+            src_files: {relative posix path: bytes}
+            dst: remote folder
+
+        Returns:
+            number of files written
+        """
+        dirs = sorted({posixpath.dirname(posixpath.join(dst, name)) for name in src_files})
+        for path in dirs:
+            parts = path.strip('/').split('/')
+            for depth in range(1, len(parts) + 1):
+                await self.md('/' + '/'.join(parts[:depth]))
+        for name, data in src_files.items():
+            await self.put(posixpath.join(dst, name), data)
+        return len(src_files)
+
+
+async def run_boards(constrs, operation, limit=32):
+    """
+    run operation on every board from one event loop, at most limit boards connected at once
+    Args:
+        constrs: connection strings
+        operation: async callable(AsyncMpFileExplorer) -> result
+        limit: boards connected at the same time
+
+    Returns:
+        [result or the exception raised for the board] in the order of constrs
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(constr):
+        async with semaphore:
+            board = await AsyncMpFileExplorer.connect(constr)
+            try:
+                return await operation(board)
+            finally:
+                await board.close()
+
+    return await asyncio.gather(*(run(constr) for constr in constrs), return_exceptions=True)
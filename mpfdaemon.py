@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Connection daemon: keeps one open MpFileShell session per board so that short `mpfshell --daemon -c`
+calls skip connecting, entering the raw REPL, setup and reading /sign. The client sends its commands
+over a Unix domain socket and the daemon streams their output back. A session is closed after it was
+idle for idle_timeout seconds, the daemon exits when it has had no session for that long.
+
+Requests and replies are JSON lines. Request: {"target", "commands", "cwd", "caching", "reset",
+"verify"} or {"stop": true}; replies: {"out": text} while the commands run, then {"exit": code}.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from mpffleet import ThreadOutput
+from pyboard import PyboardError
+from utility.file_util import init_home_path
+
+SOCKET_FILE = 'daemon.sock'
+IDLE_TIMEOUT = 300  # seconds
+START_TIMEOUT = 10  # seconds the client waits for a daemon it started
+REFUSED_COMMANDS = ('repl', 'r', 'fleet')  # need a terminal or open their own sessions
+
+
+def default_socket_path():
+    return os.path.join(init_home_path(), SOCKET_FILE)
+
+
+class _Session:
+    __slots__ = ('shell', 'caching', 'home', 'last_used')
+
+    def __init__(self, shell, caching):
+        self.shell = shell
+        self.caching = caching
+        self.home = shell.fe.pwd()
+        self.last_used = time.time()
+
+
+class _ClientStream:
+    """file-like for ThreadOutput, sends what the commands print to the client as it comes"""
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self.connected = True
+
+    def send(self, message):
+        if not self.connected:
+            return
+        try:
+            self._wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+            self._wfile.flush()
+        except OSError:
+            # the client went away, the commands still run to the end
+            self.connected = False
+
+    def write(self, data):
+        if data:
+            self.send({'out': data})
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, make_shell, normalize_target, idle_timeout=IDLE_TIMEOUT):
+        """
+        Args:
+            make_shell: callable(caching, reset, verify) returning a new, not connected MpFileShell
+            normalize_target: callable turning an open argument into the target string used by open
+        """
+        self.make_shell = make_shell
+        self.normalize_target = normalize_target
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        # commands of all sessions run one at a time: the local working directory is per process
+        self.run_lock = threading.Lock()
+        self.last_active = time.time()
+        self.output = ThreadOutput(sys.stdout)
+        umask = os.umask(0o177)  # only this user may connect
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def serve(self):
+        sys.stdout = self.output
+        reaper = threading.Thread(target=self._reap, name='mpf-daemon-reaper', daemon=True)
+        reaper.start()
+        try:
+            self.serve_forever(poll_interval=0.5)
+        finally:
+            sys.stdout = self.output._stream
+            with self.run_lock:
+                for target in list(self.sessions):
+                    self._close_session(target)
+            self.server_close()
+            try:
+                os.remove(self.server_address)
+            except OSError:
+                pass
+            logging.info('daemon stopped')
+
+    def _reap(self):
+        while True:
+            time.sleep(min(5.0, self.idle_timeout / 2))
+            with self.run_lock:
+                now = time.time()
+                for target, session in list(self.sessions.items()):
+                    if now - session.last_used > self.idle_timeout:
+                        logging.info(f'daemon: close idle session {target}')
+                        self._close_session(target)
+                if not self.sessions and now - self.last_active > self.idle_timeout:
+                    break
+        logging.info('daemon: idle, exit')
+        self.shutdown()
+
+    def _close_session(self, target):
+        session = self.sessions.pop(target)
+        try:
+            session.shell.do_close('')
+        except (Exception, PyboardError) as e:
+            logging.error(f'daemon: close {target}: {e}')
+
+    def _session(self, target, caching, reset, verify):
+        """open session of target, connected if needed, None if the board could not be opened"""
+        session = self.sessions.get(target)
+        if session is not None:
+            if session.caching != caching:
+                self._close_session(target)
+            else:
+                try:
+                    session.shell.fe.eval('1')  # the board may have been reset since
+                except (Exception, PyboardError) as e:
+                    logging.warning(f'daemon: session {target} lost, reconnect: {e}')
+                    self._close_session(target)
+        session = self.sessions.get(target)
+        if session is None:
+            shell = self.make_shell(caching, reset, verify)
+            shell.do_open(target)
+            if shell.fe is None:  # the shell printed why
+                return None
+            session = self.sessions[target] = _Session(shell, caching)
+            logging.info(f'daemon: opened session {target}')
+        session.shell.verify = verify
+        session.shell.fe.dir = session.home  # every call starts where a new connection would
+        return session
+
+    def run(self, request, stream) -> int:
+        """run the commands of request, output goes to stream, returns the exit code"""
+        target = self.normalize_target(request['target'])
+        commands = request['commands']
+        for command in commands:
+            if command.split()[0] in REFUSED_COMMANDS:
+                stream.write(f'\n{command.split()[0]} is not available through the daemon\n\n')
+                return 2
+
+        with self.run_lock:
+            self.last_active = time.time()
+            self.output.capture(stream)
+            cwd = os.getcwd()
+            try:
+                os.chdir(request['cwd'])
+                try:
+                    session = self._session(target, request.get('caching', True), request.get('reset', False),
+                                            request.get('verify', False))
+                except (Exception, PyboardError) as e:
+                    logging.error(f'daemon: {target}: {e}')
+                    stream.write(f'\n{e}\n\n')
+                    return 1
+                if session is None:
+                    return 1
+
+                shell = session.shell
+                errors = shell.errors
+                for command in commands:
+                    if shell.onecmd(command):  # quit
+                        break
+                    if shell.fe is None:  # close, or the connection failed
+                        break
+                if shell.fe is None:
+                    self.sessions.pop(target, None)
+                else:
+                    session.last_used = time.time()
+                return 0 if shell.errors == errors else 1
+            finally:
+                os.chdir(cwd)
+                self.output.release()
+                self.last_active = time.time()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        stream = _ClientStream(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError as e:
+            stream.send({'exit': 2, 'error': f'bad request: {e}'})
+            return
+        if request.get('stop'):
+            stream.send({'exit': 0})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        try:
+            code = self.server.run(request, stream)
+        except (Exception, PyboardError) as e:
+            logging.exception(e)
+            stream.write(f'\n{e}\n\n')
+            code = 1
+        stream.send({'exit': code})
+
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def serve(socket_path, make_shell, normalize_target, idle_timeout=IDLE_TIMEOUT):
+    """run a daemon in this process until it is idle or stopped, returns at once if one already runs"""
+    try:
+        _connect(socket_path).close()
+        logging.info(f'daemon already running on {socket_path}')
+        return
+    except OSError:
+        pass
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # left by a daemon that did not exit cleanly
+    logging.info(f'daemon listening on {socket_path}')
+    Daemon(socket_path, make_shell, normalize_target, idle_timeout).serve()
+
+
+def spawn(socket_path, idle_timeout=IDLE_TIMEOUT, args=()):
+    """start a daemon in the background, detached from this terminal, its log goes to ~/.mpfshell/log"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mpfshell.py'),
+               '--daemon-serve', '--socket', socket_path, '--idle-timeout', str(idle_timeout)] + list(args)
+    subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     cwd=init_home_path(), start_new_session=True)
+
+
+def request(socket_path, message, out=None, autostart=None) -> int:
+    """
+    send message to the daemon, print the output it streams back
+    Args:
+        out: stream for the output, sys.stdout if None
+        autostart: callable starting a daemon when none answers, None to fail instead
+
+    Returns:
+        exit code of the commands
+    """
+    out = out or sys.stdout
+    try:
+        sock = _connect(socket_path)
+    except OSError:
+        if autostart is None:
+            raise
+        autostart()
+        deadline = time.time() + START_TIMEOUT
+        while True:
+            time.sleep(0.1)
+            try:
+                sock = _connect(socket_path)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+    with sock, sock.makefile('rwb') as fp:
+        fp.write(json.dumps(message).encode('utf-8') + b'\n')
+        fp.flush()
+        for line in fp:
+            reply = json.loads(line.decode('utf-8'))
+            if 'out' in reply:
+                out.write(reply['out'])
+                out.flush()
+            elif 'exit' in reply:
+                if reply.get('error'):
+                    out.write(reply['error'] + '\n')
+                return reply['exit']
+    out.write('daemon closed the connection\n')
+    return 1
@@ -24,6 +24,8 @@
 
 
 import os
+import io
+import codecs
 import posixpath  # force posix-style slashes
 import re
 import sre_constants
@@ -31,19 +33,32 @@ import binascii
 import getpass
 import logging
 import subprocess
-import ast
 import sys
+import json
+import struct
+import time
+import hashlib
+from contextlib import contextmanager
 from pathlib import Path
 
 from pyboard import Pyboard
 from pyboard import PyboardError
+from pyboard import PyboardPipelineError
 from conserial import ConSerial
 from contelnet import ConTelnet
 from conwebsock import ConWebsock
 from conbase import ConError
 from retry import retry
-from utility.file_util import MD5Varifier
-from utility.utils import repeat_inquiry
+from utility.file_util import MD5Varifier, init_home_path
+from utility.cache import DigestCache, DirCache, ListingStore
+from utility.codec import select_codecs
+from utility.agent import ACK, COMPRESSED, AGENT_SOURCE, ARCHIVE_DIR, ARCHIVE_FILE, ARCHIVE_END
+from utility.compress import DECOMPRESSOR_SOURCE, compress_chunk
+from utility.delta import BLOCK_SIZE, parse_remote_blocks, changed_runs
+from utility.prepare import PreparePipeline, prepare_file
+from utility.listing import LIST_SOURCE, parse_listing, parse_walk_line, parse_removed
+from utility.hashing import HASH_SOURCE, sha256_file
+from utility.utils import repeat_inquiry, ChunkSizer
 
 
 def _was_file_not_existing(exception):
@@ -67,8 +82,25 @@ class RemoteIOError(IOError):
 
 class MpFileExplorer(Pyboard):
 
-    BIN_CHUNK_SIZE = 16 * 100
+    BIN_CHUNK_SIZE = 16 * 100  # initial chunk size, adjusted by chunk_sizer
+    DELTA_MIN_SIZE = 32 * 1024  # smaller files are always uploaded in full
     MAX_TRIES = 3
+    PIPELINE_WINDOW = 4  # commands in flight over telnet/websocket, serial input buffers only hold one
+    HASH_BATCH = 64  # paths hashed by one exec of remote_digests
+    DIGEST_CACHE_FILE = 'digest_cache.json'  # in the mpfshell home path, digests of local files
+
+    PROFILE_FILE = 'board_profiles.json'  # overrides BOARD_PROFILES, e.g. {"ESP32": {"transfer_agent": true}}
+    DEFAULT_PROFILE = {
+        'os_lib': 'os',
+        'exec_tool': 'shell',
+        'transfer_agent': False,  # install utility/agent.py on the board, serial connections only
+        'pipeline_window': None,  # commands in flight during exec based writes, None picks by connection
+        'device_hash': True,  # skip uploads by the sha256 of the files on the board, not only by /sign
+    }
+    BOARD_PROFILES = {
+        'stm32l401': {'os_lib': 'uos'},
+        'ESP8266': {'exec_tool': 'repl'},
+    }
 
     def __init__(self, constr, reset=False, os_lib='os'):
         """
@@ -83,9 +115,19 @@ class MpFileExplorer(Pyboard):
 
         logging.info('Init MpFileExplorer')
         self.reset = reset
-        self.md5_varifier = MD5Varifier()
+        self.digest_cache = DigestCache.shared(os.path.join(init_home_path(), self.DIGEST_CACHE_FILE))
+        self.md5_varifier = MD5Varifier(digest_cache=self.digest_cache)
         self._os_lib = os_lib
         self._exec_tool = 'shell'
+        self._agent = False
+        self._agent_active = False  # a put or unpack of the agent reads stdin, ctrl-C disabled
+        self._decompressor = False
+        self._remote_hash = False
+        self._device_hash = False
+        self._precompressed = {}  # chunk: compressed chunk, prepared in advance for the file being written
+        self._resume_put = {}  # remote path: {'digest': sha256 of data, 'offset': acknowledged bytes}
+        self._resume_get = {}  # remote path: {'dst': local path, 'offset': received bytes}
+        self.pipeline_window = 1
 
         try:
             Pyboard.__init__(self, self.__con_from_str(constr))
@@ -94,6 +136,8 @@ class MpFileExplorer(Pyboard):
 
         self.dir = None
         self.sysname = None
+        self._write_codec, self._read_codec = select_codecs(has_base64=False)
+        self.chunk_sizer = ChunkSizer(self.BIN_CHUNK_SIZE)
         self.setup()
         self._init_md5_varify()
 
@@ -125,7 +169,8 @@ class MpFileExplorer(Pyboard):
             else:
                 baudrate = 115200
 
-            con = ConSerial(port=port, baudrate=baudrate, reset=self.reset)
+            # the lock makes scan and the other mpfshell processes see the port as in use
+            con = ConSerial(port=port, baudrate=baudrate, reset=self.reset, exclusive=True)
 
         elif proto.strip(" ") == "tn":
 
@@ -172,6 +217,7 @@ class MpFileExplorer(Pyboard):
     def close(self):
         logging.info('Close the connection')
 
+        self.digest_cache.save()
         Pyboard.close(self)
         self.dir = None
 
@@ -187,11 +233,11 @@ class MpFileExplorer(Pyboard):
         board_model = self.get_board_info()
         logging.info(f'Get board model is {board_model}')
         self.exit_raw_repl()
-        if board_model == 'stm32l401':
+        profile = self._board_profile(board_model)
+        if profile['os_lib'] == 'uos':
             self._os_lib = 'uos'
             logging.info('Set os lib is uos on board')
-        elif board_model == 'ESP8266':
-            self._exec_tool = 'repl'
+        self._exec_tool = profile['exec_tool']
 
         self.enter_raw_repl()
         if self._os_lib == 'uos':
@@ -206,12 +252,154 @@ class MpFileExplorer(Pyboard):
         logging.info(f'Set work dir is {self.dir}')
 
         self.__set_sysname()
+        self.__set_codecs()
+        self.__set_chunk_sizer()
+        self.__set_decompressor()
+        self.__set_remote_hash()
+        self._device_hash = self._remote_hash and profile['device_hash']
+        self.exec_(LIST_SOURCE)
+        self._agent = False
+        if profile['transfer_agent']:
+            self.__install_agent()
+        self.__set_pipeline_window(profile['pipeline_window'])
+
+    def __set_pipeline_window(self, window):
+        """stop-and-wait on serial links, whose input buffer overflows, pipelined on network links"""
+        if not window:
+            window = 1 if isinstance(self.con, ConSerial) else self.PIPELINE_WINDOW
+        self.pipeline_window = window
+        logging.info(f'Set pipeline window is {self.pipeline_window}')
+
+    def __set_decompressor(self):
+        """define _mpf_z on the board if the firmware has deflate, zlib or uzlib"""
+        try:
+            self.exec_(DECOMPRESSOR_SOURCE)
+            self._decompressor = True
+        except PyboardError as e:
+            logging.info(f'No decompressor on board, uploads are not compressed: {e}')
+            self._decompressor = False
+
+    def __set_remote_hash(self):
+        """define the hash helpers on the board for delta uploads and transfer verification"""
+        try:
+            self.exec_(HASH_SOURCE)
+            self._remote_hash = True
+        except PyboardError as e:
+            logging.info(f'No sha256 on board, delta uploads and hash verification are disabled: {e}')
+            self._remote_hash = False
+
+    def __set_chunk_sizer(self):
+        """bound the chunk size by the free RAM of the board"""
+        try:
+            self.exec_("import gc")
+            self.exec_("gc.collect()")
+            mem_free = int(self.eval("gc.mem_free()"))
+        except (PyboardError, ValueError) as e:
+            logging.error(e)
+            mem_free = None
+        self.chunk_sizer = ChunkSizer(self.chunk_sizer.size, mem_free)
+        logging.info(f'Board mem free {mem_free}, chunk size {self.chunk_sizer.size} (max {self.chunk_sizer.upper})')
+
+    def _board_profile(self, board_model):
+        """
+        settings of board_model, PROFILE_FILE in the local work path takes precedence over BOARD_PROFILES
+        """
+        profile = dict(self.DEFAULT_PROFILE)
+        profile.update(self.BOARD_PROFILES.get(board_model, {}))
+        if os.path.exists(self.PROFILE_FILE):
+            try:
+                with open(self.PROFILE_FILE, 'r') as fp:
+                    profile.update(json.load(fp).get(board_model, {}))
+            except (ValueError, OSError) as e:
+                logging.error(f'invalid {self.PROFILE_FILE}: {e}')
+        logging.info(f'Board profile of {board_model} is {profile}')
+        return profile
+
+    def __install_agent(self):
+        """install the transfer agent, keep the exec based transfers if the board cannot run it"""
+        if not isinstance(self.con, ConSerial):
+            logging.info('Transfer agent needs a serial connection, use exec based transfers')
+            return
+        try:
+            self.exec_(AGENT_SOURCE)
+        except PyboardError as e:
+            logging.warning(f'Failed to install transfer agent, use exec based transfers: {e}')
+        else:
+            self._agent = True
+            logging.info('Transfer agent installed')
+
+    def __set_codecs(self):
+        """probe which wire encodings the firmware supports, once per session"""
+        try:
+            has_base64 = self.eval("hasattr(ubinascii, 'a2b_base64') and hasattr(ubinascii, 'b2a_base64')") == b'True'
+        except PyboardError as e:
+            logging.error(e)
+            has_base64 = False
+        self._write_codec, self._read_codec = select_codecs(has_base64)
+        logging.info(f'Set transfer codecs: write {self._write_codec.name}, read {self._read_codec.name}')
 
     def _init_md5_varify(self):
         logging.info('Init md5 varify cache')
         remote_sign = self.md5_varifier.cache_file
-        cache_data = self._do_read_remote(remote_sign)  # 读取出来的data
+        try:
+            cache_data = self._do_read_remote(remote_sign)  # 读取出来的data
+        except RemoteIOError:
+            cache_data = b''  # a new board, the sign file is created below
         self.md5_varifier.init_cache(cache_data)
+        # an empty or missing sign file gets its header now, so every later change is a plain append
+        if not self.md5_varifier.appendable or self.md5_varifier.needs_compaction:
+            self.__write_sign()
+
+    @contextmanager
+    def sign_batch(self):
+        """
+        collect the sign changes of a command. Every change is appended to the sign file on the board as
+        it happens, the file is rewritten at most once, when the outermost batch ends
+        """
+        self.md5_varifier.begin()
+        try:
+            yield
+        except BaseException as e:
+            try:
+                self.__commit_sign()
+            except BaseException as commit_error:
+                logging.error(f'Sign file not compacted: {commit_error}')
+            raise e
+        self.__commit_sign()
+
+    def __commit_sign(self):
+        if self.md5_varifier.commit():
+            self.__write_sign()
+
+    def __write_sign(self):
+        sign_value = self.md5_varifier._update_cache_file()
+        self._do_write_remote(self.md5_varifier.cache_file, sign_value, verify=False)
+        self.md5_varifier.written()
+
+    def _record_sign(self, sign_value, file_paths_remote):
+        """
+        store changed signs on the board
+        Args:
+            sign_value: what MD5Varifier returned for the change, nothing is stored if it is falsy
+            file_paths_remote: remote paths whose sign changed
+
+        """
+        if not sign_value:
+            return
+        data = self.md5_varifier.append_lines(file_paths_remote)
+        if data is False:
+            self.__write_sign()
+            return
+        if len(data) <= self.chunk_sizer.size:
+            # the usual single line goes in one exec
+            self.exec_("with open('%s', 'ab') as f:\r\n    f.write(%s)"
+                       % (self.md5_varifier.cache_file, self._write_codec.encode(data)))
+        else:
+            self.exec_("f = open('%s', 'ab')" % self.md5_varifier.cache_file)
+            self._exec_write_range(data, 0, len(data))
+            self.exec_("f.close()")
+        if not self.md5_varifier.in_batch and self.md5_varifier.needs_compaction:
+            self.__write_sign()
 
     def __list_dir(self, path_):
         logging.info(f'get listdir of {path_}')
@@ -226,83 +414,84 @@ class MpFileExplorer(Pyboard):
             logging.error(e)
             raise e
 
+    def walk(self, path=None):
+        """
+        list a remote file or folder tree in one device side traversal
+        Args:
+            path: remote file/folder path, the current working path by default
+
+        Returns:
+            [(path, 'D' or 'F', size, mtime)] of path itself and every node below it, a folder comes
+            before its content. Paths are absolute
+
+        """
+        path = self._fqn(path) if path else self.dir
+        logging.info(f'walk {path}')
+        nodes = []
+        pending = b''
+
+        def data_consumer(data):
+            nonlocal pending
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                node = parse_walk_line(line)
+                if node:
+                    nodes.append(node)
+
+        try:
+            self.exec_stream("_mpf_walk('%s')" % path, data_consumer)
+        except PyboardError as e:
+            if _was_file_not_existing(e):
+                raise RemoteIOError("No such file or directory: %s" % path)
+            raise e
+        node = parse_walk_line(pending)
+        if node:
+            nodes.append(node)
+        return nodes
+
+    def device_id(self):
+        """
+        Returns:
+            hex of machine.unique_id(), None if the firmware does not provide it
+
+        """
+        try:
+            self.exec_("import machine")
+            return self.eval("ubinascii.hexlify(machine.unique_id()).decode()").decode('utf-8')
+        except PyboardError as e:
+            logging.info(f'No unique id on board: {e}')
+            return None
+
+    def list_dir(self, path=None):
+        """
+        list a remote folder in one round trip
+        Args:
+            path: remote folder path, the current working path by default
+
+        Returns:
+            [(name, 'D' or 'F', size)]
+
+        """
+        path = self._fqn(path) if path else self.dir
+        logging.info(f'list dir {path}')
+        return parse_listing(self.exec_("_mpf_ls('%s')" % path))
+
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
     def ls(self, add_files=True, add_dirs=True, add_details=False):
         logging.info(f'ls {self.dir}')
 
-        files = set()
-
         try:
-
-            res = self.__list_dir(self.dir)
-            if res is None:
-                return files
-            tmp = ast.literal_eval(res.decode('utf-8'))
-            if not add_details and add_dirs:
-                return tmp
-            if add_dirs:
-                for f in tmp:
-                    try:
-
-                        # if it is a dir, it could be listed with "os.listdir"
-                        ret_inner_tmp = self.__list_dir(f"{self.dir}/{f}")  # os/Path的拼接都不行
-                        if ret_inner_tmp is None:
-                            files.add((f, 'F'))
-                        else:
-                            ret_inner = ast.literal_eval(ret_inner_tmp.decode('utf-8'))
-                            if len(ret_inner) > 0:
-                                files.add((f, 'D'))
-                            else:
-                                files.add((f, 'F'))
-
-                    except PyboardError as e:
-
-                        if _was_file_not_existing(e):
-                            # this was not a dir
-                            if 'EBADF' or 'ENOTDIR' in str(e):
-                                if add_details:
-                                    files.add((f, 'F'))
-                                else:
-                                    files.add(f)
-                            elif self.sysname == "WiPy" and self.dir == "/":
-                                # for the WiPy, assume that all entries in the root of th FS
-                                # are mount-points, and thus treat them as directories
-                                if add_details:
-                                    files.add((f, 'D'))
-                                else:
-                                    files.add(f)
-                        else:
-                            raise e
-
-            if add_files and not (self.sysname == "WiPy" and self.dir == "/"):
-                for f in tmp:
-                    try:
-
-                        # if it is a file, "os.listdir" must fail TODO 没有os又怎么办呢？
-                        if self._os_lib == 'os':
-                            self.eval("os.listdir('%s/%s')" % (self.dir.rstrip('/'), f))
-
-                    except PyboardError as e:
-
-                        if 'EBADF' or 'ENOTDIR' in str(e):
-                            if add_details:
-                                files.add((f, 'F'))
-                            else:
-                                files.add(f)
-                        elif _was_file_not_existing(e):
-                            if add_details:
-                                files.add((f, 'F'))
-                            else:
-                                files.add(f)
-                        else:
-                            raise e
-
-        except Exception  as e:
+            entries = self.list_dir()
+        except PyboardError as e:
             if _was_file_not_existing(e):
                 raise RemoteIOError("No such directory: %s" % self.dir)
-            else:
-                raise PyboardError(e)
+            raise e
 
+        files = set()
+        for name, file_type, _ in entries:
+            if (file_type == 'D' and add_dirs) or (file_type == 'F' and add_files):
+                files.add((name, file_type) if add_details else name)
         return files
 
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
@@ -317,7 +506,7 @@ class MpFileExplorer(Pyboard):
                 raise e
             else:
                 sign_value = self.md5_varifier.rm_sign(self._fqn(target))
-                self._do_write_remote(self.md5_varifier.cache_file, sign_value)
+                self._record_sign(sign_value, [self._fqn(target)])
                 logging.info(f"rm {self._fqn(target)} success")
             finally:
                 return
@@ -345,7 +534,7 @@ class MpFileExplorer(Pyboard):
         else:
             logging.info(f"rm {self._fqn(target)} success")
             sign_value = self.md5_varifier.rm_sign(self._fqn(target))
-            self._do_write_remote(self.md5_varifier.cache_file, sign_value)
+            self._record_sign(sign_value, [self._fqn(target)])
 
     def mrm(self, pat):
         logging.info(f'mrm {pat}')
@@ -353,17 +542,23 @@ class MpFileExplorer(Pyboard):
         files = self.ls(add_dirs=False, add_details=True)
         find = re.compile(pat)
 
-        for f in files:
-            file_name, file_type = f
-            if find.match(file_name):
-                self.rm(file_name)
+        with self.sign_batch():
+            for f in files:
+                file_name, file_type = f
+                if find.match(file_name):
+                    self.rm(file_name)
 
-    def _do_write_remote(self, dst: str, data: bytes, verbose=False) -> None:
+    def _do_write_remote(self, dst: str, data: bytes, verbose=False, compress=False, verify=True,
+                         digest=None) -> None:
         """
-        write operation on remote file
+        write operation on remote file. An interrupted write of the same data continues from the
+        last acknowledged chunk when it is called again
         Args:
             dst: remote file path
             data: fp.read()
+            compress: send deflate compressed chunks, needs the decompressor on board
+            verify: check the remote file against data at the end
+            digest: sha256 hex of data if already known
 
         Returns:
             None
@@ -372,20 +567,24 @@ class MpFileExplorer(Pyboard):
         logging.info(f"write data to {self._fqn(dst)}")
         try:
 
-            self.exec_("f = open('%s', 'wb')" % self._fqn(dst))
-
-            file_size = len(data)
-            while True:
-                c = binascii.hexlify(data[:self.BIN_CHUNK_SIZE])
-                if not len(c):
-                    break
+            compress = compress and self._decompressor
+            fqn = self._fqn(dst)
+            digest = digest or hashlib.sha256(data).hexdigest()
+            offset = self.__resume_put_offset(fqn, digest)
+            state = self._resume_put[fqn] = {'digest': digest, 'offset': offset}
 
-                self.exec_("f.write(ubinascii.unhexlify('%s'))" % c.decode('utf-8'))
-                data = data[self.BIN_CHUNK_SIZE:]
+            self.chunk_sizer.start()
+            if self._agent:
+                self._agent_write_remote(dst, data, verbose=verbose, compress=compress, state=state)
+            else:
+                self.exec_("f = open('%s', '%s')" % (fqn, 'ab' if offset else 'wb'))
+                self._exec_write_range(data, offset, len(data), compress=compress, verbose=verbose, state=state)
+                self.exec_("f.close()")
+            self.__report_chunk_size(dst, verbose)
 
-                if verbose:
-                    print("\ttransfer %d of %d" % (file_size - len(data), file_size))
-            self.exec_("f.close()")
+            if verify:
+                self.__verify_remote(fqn, digest, len(data))
+            self._resume_put.pop(fqn, None)
 
         except PyboardError as e:
             if _was_file_not_existing(e):
@@ -397,36 +596,371 @@ class MpFileExplorer(Pyboard):
             else:
                 raise e
 
-    def _put_file(self, src, dst, verbose=False) -> None:
+    def __resume_put_offset(self, fqn, digest):
+        """
+        offset to continue an interrupted write of the same data, 0 to start over
+        """
+        state = self._resume_put.get(fqn)
+        if not state or state['digest'] != digest or not state['offset']:
+            return 0
+        try:
+            # flush what the interrupted write left in the file handle
+            self.exec_("f.close()")
+        except PyboardError:
+            pass
+        size = self._remote_size(fqn)
+        if size != state['offset']:
+            logging.warning(f'{fqn} has {size} bytes, {state["offset"]} acknowledged, write it again')
+            return 0
+        logging.info(f'resume writing {fqn} from {size}')
+        print(f" * resume {fqn} from {size} bytes")
+        return size
+
+    def __remote_sha(self, fqn):
+        return self.exec_("_mpf_sha('%s')" % fqn).decode('utf-8').strip()
+
+    def remote_digests(self, paths) -> dict:
+        """
+        sha256 of remote files computed on the board, HASH_BATCH paths per exec, pipelined
+        Args:
+            paths: iterable of absolute remote paths
+
+        Returns:
+            {path: hex digest, None if the file does not exist}
+
+        """
+        paths = list(paths)
+        digests = {}
+
+        def commands():
+            for start in range(0, len(paths), self.HASH_BATCH):
+                yield "_mpf_shas(%r)" % (paths[start:start + self.HASH_BATCH],)
+
+        def on_result(index, ret):
+            for line in ret.decode('utf-8').splitlines():
+                digest, _, path = line.partition(' ')
+                if path:
+                    digests[path] = None if digest == '-' else digest
+
+        self.exec_pipelined(commands(), window=self.pipeline_window, on_result=on_result)
+        return digests
+
+    def __verify_remote(self, fqn, digest, size):
+        """
+        compare the remote file with the sha256 digest (or the size if the board has no sha256)
+        """
+        if self._remote_hash:
+            ok = self.__remote_sha(fqn) == digest
+        else:
+            ok = self._remote_size(fqn) == size
+        if not ok:
+            self._resume_put.pop(fqn, None)
+            raise PyboardError(f'verification of {fqn} failed, auto try again.')
+
+    def _exec_write_range(self, data: bytes, start: int, end: int, compress=False, seek=False, verbose=False,
+                          state=None):
+        """
+        write data[start:end] to the remote file f opened by the caller, one exec per chunk with up to
+        pipeline_window chunks in flight
+        Args:
+            seek: seek f to start before writing, for in-place patches
+            state: resume state, its offset follows every acknowledged chunk
+        """
+        offset = start
+        restart = seek
+        while offset < end:
+            sent = []  # (offset, length) of every chunk command, by index
+            last = time.time()
+
+            def commands(position, restart):
+                while position < end:
+                    chunk = data[position:min(end, position + self.chunk_sizer.size)]
+                    command = "f.seek(%d)\r\n" % position if restart else ""
+                    restart = False
+                    compressed = self._compress_chunk(chunk) if compress else None
+                    if compressed is None:
+                        command += "f.write(%s)" % self._write_codec.encode(chunk)
+                    else:
+                        command += "f.write(_mpf_z(%s))" % self._write_codec.encode(compressed)
+                    sent.append((position, len(chunk)))
+                    position += len(chunk)
+                    yield command
+
+            def on_result(index, ret):
+                nonlocal offset, last
+                position, length = sent[index]
+                now = time.time()
+                self.chunk_sizer.record(length, now - last)
+                last = now
+                offset = position + length
+                if state is not None:
+                    state['offset'] = offset
+                if verbose:
+                    print("\ttransfer %d of %d" % (offset, len(data)))
+
+            try:
+                self.exec_pipelined(commands(offset, restart), window=self.pipeline_window, on_result=on_result)
+            except PyboardPipelineError as e:
+                if 'MemoryError' in str(e) and self.chunk_sizer.memory_error():
+                    logging.warning(f'MemoryError on board at {sent[e.index][0]}, '
+                                    f'chunk size down to {self.chunk_sizer.size}')
+                    # chunks in flight behind the failed one were written at its position
+                    restart = True
+                    continue
+                raise e
+
+    def _delta_write_remote(self, dst: str, data: bytes, verbose=False, compress=False, digest=None) -> bool:
+        """
+        patch only the blocks of the remote file that differ from data, then verify the whole file
+        Args:
+            digest: sha256 hex of data if already known
+
+        Returns:
+            False if the remote file cannot be patched, the caller does a full upload then
+
+        """
+        if not self._remote_hash or len(data) < self.DELTA_MIN_SIZE:
+            return False
+        try:
+            ret = self.exec_("_mpf_blocks('%s', %d)" % (self._fqn(dst), BLOCK_SIZE))
+            remote_size, remote_digests = parse_remote_blocks(ret)
+        except (PyboardError, ValueError, IndexError) as e:
+            logging.warning(f'Failed to hash blocks of {self._fqn(dst)}: {e}')
+            return False
+        runs = changed_runs(data, remote_size, remote_digests)
+        if runs is None:
+            return False
+        changed = sum(length for _, length in runs)
+        if changed > len(data) // 2:
+            logging.info(f'{changed} of {len(data)} bytes changed, full upload of {self._fqn(dst)}')
+            return False
+
+        logging.info(f'delta upload of {self._fqn(dst)}: {changed} of {len(data)} bytes in {len(runs)} runs')
+        if verbose:
+            print("\tdelta %d of %d bytes" % (changed, len(data)))
+        compress = compress and self._decompressor
+        fqn = self._fqn(dst)
+        self._resume_put.pop(fqn, None)  # the file is patched in place, an earlier write cannot resume
+        self.exec_("f = open('%s', 'r+b')" % fqn)
+        self.chunk_sizer.start()
+        for offset, length in runs:
+            self._exec_write_range(data, offset, offset + length, compress=compress, seek=True, verbose=verbose)
+        self.exec_("f.close()")
+        self.__report_chunk_size(dst, verbose)
+        # the block digests only cover what was patched, check the whole file like a full write
+        self.__verify_remote(fqn, digest or hashlib.sha256(data).hexdigest(), len(data))
+        return True
+
+    def _agent_error(self, data):
+        """
+        collect the traceback after the agent stopped with data instead of a frame
+        """
+        if data.endswith(b'\x04'):
+            ret, ret_err = data[:-1], self.read_until(1, b'\x04')[:-1]
+        else:
+            ret, ret_err = self.follow(timeout=4)
+            ret = data + ret
+        return PyboardError('exception', ret, ret_err)
+
+    def _agent_resync(self):
+        """drop what is left of a frame the board did not read and get a clean raw REPL"""
+        logging.warning('Resync raw repl after transfer agent error')
+        self._agent_active = False
+        self.exit_raw_repl()
+        self.enter_raw_repl()
+
+    def _agent_write_remote(self, dst: str, data: bytes, verbose=False, compress=False, state=None) -> None:
+        """
+        write remote file in a single exchange with the transfer agent, appending from state['offset']
+        """
+        offset = state['offset'] if state else 0
+        self.exec_raw_no_follow("_mpf_put('%s', '%s')" % (self._fqn(dst), 'ab' if offset else 'wb'))
+        self._agent_active = True
+        try:
+            self._agent_send_frames(data, offset, verbose=verbose, compress=compress, state=state)
+        except BaseException:
+            self._agent_abort()
+            raise
+        self._agent_active = False
+        ret, ret_err = self.follow(timeout=4)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+
+    def _agent_send_frames(self, data: bytes, offset=0, verbose=False, compress=False, state=None) -> None:
+        """
+        send data[offset:] as put frames to the running agent, one acknowledged frame per chunk
+        """
+        file_size = len(data)
+        try:
+            while offset < file_size:
+                chunk = data[offset:offset + self.chunk_sizer.size]
+                start = time.time()
+                compressed = self._compress_chunk(chunk) if compress else None
+                if compressed is None:
+                    self.con.write(struct.pack('<H', len(chunk)) + chunk)
+                else:
+                    self.con.write(struct.pack('<H', COMPRESSED | len(compressed)) + compressed)
+                self._agent_ack()
+                self.chunk_sizer.record(len(chunk), time.time() - start)
+                offset += len(chunk)
+                if state is not None:
+                    state['offset'] = offset
+                if verbose:
+                    print("\ttransfer %d of %d" % (offset, file_size))
+        finally:
+            # end the file on the board also when the host failed, unless the agent stopped already
+            if self._agent_active:
+                self.con.write(struct.pack('<H', 0))
+
+    def _agent_abort(self, terminator=b''):
+        """
+        end the running agent command after an error on the host, the board would take whatever
+        comes next as frames. terminator closes the command at the frame it waits for
+        """
+        if not self._agent_active:
+            return
+        self._agent_active = False
+        try:
+            if terminator:
+                self.con.write(terminator)
+            self.follow(timeout=4)
+        except (Exception, PyboardError) as e:
+            logging.warning(f'transfer agent did not stop: {e}')
+            self._agent_resync()
+
+    def _compress_chunk(self, chunk):
+        """compress_chunk, taken from the chunks prepared in advance if they have it"""
+        try:
+            return self._precompressed[chunk]
+        except KeyError:
+            return compress_chunk(chunk)
+
+    def _agent_ack(self):
+        """wait for the agent to acknowledge a frame, raise its traceback if it stopped instead"""
+        ack = self.con.read(1)
+        if ack != ACK:
+            e = self._agent_error(ack)
+            self._agent_resync()
+            raise e
+
+    def __report_chunk_size(self, dst, verbose=False):
+        logging.info(f'transfer {self._fqn(dst)} with chunk size {self.chunk_sizer.size}')
+        if verbose:
+            print("\tchunk size %d" % self.chunk_sizer.size)
+
+    def _put_file(self, src, dst, verbose=False, verify=False) -> None:
         """
         upload local file to remote
         Args:
             src:
             dst:
+            verify: confirm the upload by the digest computed on the board
 
         Returns:
             None
 
         """
-        cache_value = self.md5_varifier.varify_sign(src, self._fqn(dst), verbose=verbose)
-        if cache_value:
-            f = open(src, "rb")
-            data = f.read()
-            f.close()
+        if dst is None:
+            dst = src
+        if self._select_changed([(src, dst)], verbose=verbose):
+            try:
+                self._write_file(src, dst, verbose=verbose)
+            except BaseException as e:
+                # forget the new sign, so that a retry uploads the file again
+                self.md5_varifier.rm_sign(self._fqn(dst))
+                raise e
+            accepted = self.md5_varifier.accept_signs([self._fqn(dst)])
+            self._record_sign(accepted, accepted)
+            if verify:
+                self._verify_uploads([(src, dst)])
+
+    def _select_changed(self, files, verbose=False) -> list:
+        """
+        update the signs of local files and pick the ones to upload
+        Args:
+            files: (local path, remote path) pairs
 
-            if dst is None:
-                dst = src
+        Returns:
+            the pairs whose remote file differs from the local one, by the digests computed on the board
+            if it can, else by the signs in /sign
+
+        """
+        signed = [self.md5_varifier.varify_sign(local, self._fqn(remote), verbose=verbose) for local, remote in files]
+        if not self._device_hash:
+            return [pair for pair, sign in zip(files, signed) if sign]
+
+        digests = self.remote_digests(self._fqn(remote) for _, remote in files)
+        changed, stale = [], []
+        for (local, remote), sign in zip(files, signed):
+            if digests.get(self._fqn(remote)) != self.digest_cache.sha256(local):
+                changed.append((local, remote))
+                if not sign:
+                    logging.warning(f'{self._fqn(remote)} changed on the board, its sign is out of date')
+            elif sign:
+                # the board already has the content, only the sign was out of date
+                stale.append(self._fqn(remote))
+        if stale:
+            self._record_sign(True, self.md5_varifier.accept_signs(stale))
+        return changed
+
+    def _verify_uploads(self, files) -> None:
+        """
+        compare uploaded files with the local ones by the digests computed on the board, in one pass
+        Args:
+            files: (local path, remote path) pairs
 
-            self._do_write_remote(dst, data)
-            self._do_write_remote(self.md5_varifier.cache_file, cache_value)
+        Raises:
+            RemoteIOError: some files differ, their signs are dropped so that the next put writes them again
+
+        """
+        if not self._remote_hash:
+            logging.warning('No sha256 on board, uploads are not verified')
+            return
+        digests = self.remote_digests(self._fqn(remote) for _, remote in files)
+        failed = [self._fqn(remote) for local, remote in files
+                  if digests.get(self._fqn(remote)) != self.digest_cache.sha256(local)]
+        if failed:
+            self._record_sign(self.md5_varifier.rm_signs(failed), failed)
+            raise RemoteIOError("Verification failed: %s" % ', '.join(failed))
+        logging.info(f'verified {len(files)} files')
+
+    def _write_file(self, src, dst, verbose=False, prepared=None) -> None:
+        """
+        write the content of local file src to remote file dst, patching only changed blocks if possible
+        Args:
+            prepared: PreparedFile of src from _prepare_files, else src is read here
+        """
+        if prepared is None:
+            prepared = prepare_file(src, dst, self.chunk_sizer.size, self._decompressor)
+        self._precompressed = prepared.chunks
+        try:
+            if not self._delta_write_remote(dst, prepared.data, verbose=verbose, compress=prepared.compress,
+                                            digest=prepared.digest):
+                self._do_write_remote(dst, prepared.data, verbose=verbose, compress=prepared.compress,
+                                      digest=prepared.digest)
+        finally:
+            self._precompressed = {}
+
+    def _prepare_files(self, files) -> PreparePipeline:
+        """
+        Args:
+            files: (local path, remote path) pairs
+
+        Returns:
+            PreparePipeline reading, hashing and compressing the files in worker threads ahead of the writes
+        """
+        # the chunk size is read when a worker starts on a file, it settles during the first transfers
+        return PreparePipeline(files, lambda local, remote: prepare_file(local, remote, self.chunk_sizer.size,
+                                                                         self._decompressor))
 
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
-    def put(self, src: str, dst: str, verbose=False):
+    def put(self, src: str, dst: str, verbose=False, verify=False):
         """
         upload local file/folder to reomte
         Args:
             src: local file path
             dst: remote file path relative to the current working path of the development board
+            verify: confirm the upload by the digest computed on the board
 
         Returns: None
 
@@ -435,39 +969,260 @@ class MpFileExplorer(Pyboard):
         if os.path.isdir(src):
             self.md(dst, varify=False)
         elif os.path.isfile(src):
-            self._put_file(src, dst, verbose=verbose)
+            self._put_file(src, dst, verbose=verbose, verify=verify)
 
-    def _do_read_remote(self, dst: str) -> bytes:
+    @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
+    def put_tree(self, src: str, dst: str, verbose=False, varify=True, verify=False) -> int:
         """
-        read operation on remote file
+        upload local folder src to remote folder dst. With the transfer agent the whole tree goes as
+        one archive unpacked by the board, else file by file. Only changed files are sent (see
+        _select_changed), in one sign batch
+        Args:
+            src: local folder path
+            dst: remote folder path relative to the current working path of the development board
+            verbose: print every file written
+            varify: create the missing parents of dst
+            verify: confirm the written files by the digests computed on the board
+
+        Returns:
+            number of files written
+
+        """
+        logging.info(f'put tree {src} to remote {self._fqn(dst)}')
+        self.md(dst, varify=varify)
+
+        dirs, files = [], []
+        for root, dir_names, file_names in os.walk(src):
+            dir_names.sort()
+            relative = os.path.relpath(root, src)
+            remote = dst if relative == '.' else posixpath.join(dst, *Path(relative).parts)
+            dirs.extend(posixpath.join(remote, name) for name in dir_names)
+            files.extend((os.path.join(root, name), posixpath.join(remote, name)) for name in sorted(file_names))
+
+        with self.sign_batch():
+            changed = self._select_changed(files)
+            logging.info(f'{len(changed)} of {len(files)} files in {src} changed')
+
+            if self._agent:
+                try:
+                    self._agent_put_tree(dirs, changed, verbose=verbose)
+                except BaseException as e:
+                    self.md5_varifier.rm_signs(self._fqn(remote) for _, remote in changed)
+                    raise e
+                accepted = self.md5_varifier.accept_signs(self._fqn(remote) for _, remote in changed)
+                self._record_sign(accepted, accepted)
+            else:
+                for remote in dirs:
+                    self.md(remote, varify=False)
+                pipeline = self._prepare_files(changed)
+                written = 0
+                try:
+                    for num, prepared in enumerate(pipeline, 1):
+                        if verbose:
+                            print(f'[{num}/{len(changed)}] Writing file {prepared.remote}'
+                                  f'({len(prepared.data) // 1024 + 1}kb)')
+                        self._write_file(prepared.local, prepared.remote, prepared=prepared)
+                        accepted = self.md5_varifier.accept_signs([self._fqn(prepared.remote)])
+                        self._record_sign(accepted, accepted)
+                        written = num
+                except BaseException as e:
+                    # forget the new signs of the files not written yet
+                    self.md5_varifier.rm_signs(self._fqn(remote) for _, remote in changed[written:])
+                    raise e
+                if verbose and changed:
+                    print(f'Prepare: {pipeline.report()}')
+            if verify and changed:
+                self._verify_uploads(changed)
+        return len(changed)
+
+    def _agent_put_tree(self, dirs, files, verbose=False) -> None:
+        """
+        stream dirs and files to the agent as one archive
+        Args:
+            dirs: remote folder paths, parents first
+            files: (local path, remote path) pairs
+        """
+        def record(kind, path):
+            path = self._fqn(path).encode('utf-8')
+            self.con.write(kind + struct.pack('<H', len(path)) + path)
+            self._agent_ack()
+
+        self.exec_raw_no_follow("_mpf_unpack()")
+        self._agent_active = True
+        self.chunk_sizer.start()
+        pipeline = self._prepare_files(files)
+        try:
+            for remote in dirs:
+                record(ARCHIVE_DIR, remote)
+            for num, prepared in enumerate(pipeline, 1):
+                if verbose:
+                    print(f'[{num}/{len(files)}] Writing file {prepared.remote}({len(prepared.data) // 1024 + 1}kb)')
+                record(ARCHIVE_FILE, prepared.remote)
+                self._precompressed = prepared.chunks
+                try:
+                    self._agent_send_frames(prepared.data, compress=prepared.compress)
+                finally:
+                    self._precompressed = {}
+        except BaseException:
+            # _agent_send_frames ended the file, the board waits for the next record
+            self._agent_abort(ARCHIVE_END + struct.pack('<H', 0))
+            raise
+        self._agent_active = False
+        self.con.write(ARCHIVE_END + struct.pack('<H', 0))
+        ret, ret_err = self.follow(timeout=4)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+        if verbose and files:
+            print(f'Prepare: {pipeline.report()}')
+
+    def _open_remote_read(self, dst: str, offset=0):
+        """
+        open remote file for reading
         Args:
             dst: remote file path
+            offset: start reading at offset
 
         Returns:
-            bytes
+            remote file size if the board reports it, else None
 
         """
-        logging.info(f'read remote file {dst}')
         try:
 
-            self.exec_("f = open('%s', 'a')" % self._fqn(dst))
-            self.exec_("f.close()")
+            if self._agent:
+                self.exec_raw_no_follow("_mpf_get('%s', %d, %d)" % (self._fqn(dst), self.chunk_sizer.start(), offset))
+                ack = self.con.read(1)
+                if ack != ACK:
+                    raise self._agent_error(ack)
+                return struct.unpack('<I', self.con.read(4))[0]
+
             self.exec_("f = open('%s', 'rb')" % self._fqn(dst))
-            ret = self.exec_(
-                "while True:\r\n"
-                "  c = ubinascii.hexlify(f.read(%s))\r\n"
-                "  if not len(c):\r\n"
-                "    break\r\n"
-                "  sys.stdout.write(c)\r\n" % self.BIN_CHUNK_SIZE
-            )
-            self.exec_("f.close()")
+            if offset:
+                self.exec_("f.seek(%d)" % offset)
 
         except PyboardError as e:
             if _was_file_not_existing(e):
                 raise RemoteIOError("Failed to read file: %s" % dst)
             else:
                 raise e
-        return ret
+
+    def _stream_remote_read(self, fp, size=None, verbose=False, state=None) -> int:
+        """
+        send the remote file opened by _open_remote_read to fp chunk by chunk, decoded as it arrives
+        Args:
+            fp: object with write(bytes)
+            size: remote file size, only used to report progress
+            verbose: if print progress
+            state: resume state, its offset follows every chunk written to fp
+
+        Returns:
+            number of bytes received
+
+        """
+        if self._agent:
+            return self._agent_stream_read(fp, size=size, verbose=verbose, state=state)
+
+        decoder = self._read_codec.decoder()
+        received = 0
+        reported = 0
+        timed = 0  # received up to the end of the last timed chunk
+        chunk_size = self.chunk_sizer.start()
+        logging.info(f'read with chunk size {chunk_size}')
+        last = time.time()
+
+        def data_consumer(data):
+            nonlocal received, reported, timed, last
+            chunk = decoder.feed(data)
+            if chunk:
+                fp.write(chunk)
+                received += len(chunk)
+                if state is not None:
+                    state['offset'] += len(chunk)
+                if received - timed >= chunk_size:
+                    # the size for the next transfer, this one reads chunk_size to the end
+                    now = time.time()
+                    self.chunk_sizer.record(chunk_size, now - last)
+                    timed += (received - timed) // chunk_size * chunk_size
+                    last = now
+                if verbose and received - reported >= chunk_size:
+                    reported = received
+                    print("\r\treceive %d of %s" % (received, size if size is not None else '?'), end='')
+
+        try:
+            self.exec_stream(
+                "while True:\r\n"
+                "  c = f.read(%s)\r\n"
+                "  if not len(c):\r\n"
+                "    break\r\n"
+                "  sys.stdout.write(%s)\r\n" % (chunk_size, self._read_codec.remote_encode('c')),
+                data_consumer
+            )
+        except PyboardError as e:
+            if 'MemoryError' in str(e):
+                self.chunk_sizer.memory_error()
+            raise e
+        self.exec_("f.close()")
+
+        tail = decoder.flush()
+        if tail:
+            fp.write(tail)
+            received += len(tail)
+            if state is not None:
+                state['offset'] += len(tail)
+        if verbose:
+            print("\r\treceive %d of %s, chunk size %d" % (received, size if size is not None else '?', chunk_size))
+        return received
+
+    def _agent_stream_read(self, fp, size=None, verbose=False, state=None) -> int:
+        received = 0
+        last = time.time()
+        while True:
+            header = self.con.read(3)
+            if header[:1] != ACK:
+                raise self._agent_error(header)
+            length = struct.unpack('<H', header[1:])[0]
+            if not length:
+                break
+            fp.write(self.con.read(length))
+            now = time.time()
+            self.chunk_sizer.record(length, now - last)
+            self.con.write(ACK)
+            last = now
+            received += length
+            if state is not None:
+                state['offset'] += length
+            if verbose:
+                print("\r\treceive %d of %s" % (received, size if size is not None else '?'), end='')
+        if verbose:
+            print("\r\treceive %d of %s, chunk size %d" % (received, size if size is not None else '?',
+                                                            self.chunk_sizer.size))
+
+        ret, ret_err = self.follow(timeout=4)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+        return received
+
+    def _remote_size(self, dst: str):
+        try:
+            return int(self.eval("%s.stat('%s')[6]" % (self._os_lib, self._fqn(dst))))
+        except (PyboardError, ValueError) as e:
+            logging.warning(e)
+            return None
+
+    def _do_read_remote(self, dst: str) -> bytes:
+        """
+        read operation on remote file
+        Args:
+            dst: remote file path
+
+        Returns:
+            bytes, decoded file content
+
+        """
+        logging.info(f'read remote file {dst}')
+        self._open_remote_read(dst)
+        buffer = io.BytesIO()
+        self._stream_remote_read(buffer)
+        return buffer.getvalue()
 
     @staticmethod
     def __mkdir_local(remote_dir):
@@ -519,11 +1274,11 @@ class MpFileExplorer(Pyboard):
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
     def get(self, src: str, dst=None, varify=True):
         """
-        read remote file and write in local file
+        read remote file or folder and write it to local
         Args:
-            src: remote file path
-            dst: local file path
-            varify: varify the remote file exists or not
+            src: remote file/folder path
+            dst: local file/folder path
+            varify: raise RemoteIOError if src does not exist, else only log it
 
         Returns:
             None
@@ -531,36 +1286,73 @@ class MpFileExplorer(Pyboard):
         """
         logging.info(f'get remote file {src} to local {dst}')
 
-        if varify:
-            files = self.ls(add_details=True)
-            file_names = [i[0] for i in files]
-            if src not in file_names:
-                print(f'src: {src}')
-                print(f'files: {file_names}')
-                raise RemoteIOError("No such file or directory: '%s'" % self._fqn(src))
-
         if dst is None:
             dst = src
 
         try:
-            ret = self._do_read_remote(src)
-        except Exception as e:
-            if str(e).startswith('Failed to read file'):  # src为文件夹路径
-                self.__mkdir_local(dst)
-                tmp_files = self.__list_dir(self._fqn(src))
-                files = ast.literal_eval(tmp_files.decode('utf-8'))
-                logging.info(f"get listdir of {src} is {files}")
-                if files:
-                    for file in files:
-                        file_path = f"{src}/{file}"  # 开发板的路径拼接不同于windows，因此手动拼接
-                        child_dst = os.path.join(dst, file)
-                        self.get(file_path, child_dst, False)
+            nodes = self.walk(src)
+        except RemoteIOError as e:
+            if varify:
+                raise e
+            logging.warning(e)
+            return
+
+        fqn, node_type, size, _ = nodes[0]
+        if node_type == 'F':
+            self._get_file(fqn, dst, size)
+            return
+
+        self.__mkdir_local(dst)
+        for path, node_type, size, _ in nodes[1:]:
+            local = os.path.join(dst, *posixpath.relpath(path, fqn).split('/'))
+            if node_type == 'D':
+                os.makedirs(local, exist_ok=True)
+            else:
+                self._get_file(path, local, size)
+
+    def _get_file(self, src: str, dst: str, size=None):
+        """
+        download remote file src to local file dst, continuing an interrupted download of it
+        """
+        fqn = self._fqn(src)
+        offset = self.__resume_get_offset(fqn, dst)
+        reported = self._open_remote_read(src, offset)
+        if reported is not None:
+            size = reported
+        if not Path(dst).parent.exists():
+            self.__mkdir_local(str(Path(dst).parent))
+        size = self._remote_size(src) if size is None else size
+        state = self._resume_get[fqn] = {'dst': dst, 'offset': offset}
+        with open(dst, 'ab' if offset else 'wb') as fp:
+            self._stream_remote_read(fp, size=size, verbose=True, state=state)
+        self.__verify_local(fqn, dst, size)
+        self._resume_get.pop(fqn, None)
+        print(f'download {src} success')
+
+    def __resume_get_offset(self, fqn, dst):
+        """
+        offset to continue an interrupted download into dst, 0 to start over
+        """
+        state = self._resume_get.get(fqn)
+        if not state or state['dst'] != dst or not state['offset']:
+            return 0
+        if not os.path.isfile(dst) or os.path.getsize(dst) != state['offset']:
+            return 0
+        logging.info(f'resume reading {fqn} from {state["offset"]}')
+        print(f" * resume {fqn} from {state['offset']} bytes")
+        return state['offset']
+
+    def __verify_local(self, fqn, dst, size):
+        """
+        compare the downloaded file with the sha256 (or the size if the board has no sha256) of the remote file
+        """
+        if self._remote_hash:
+            ok = self.__remote_sha(fqn) == sha256_file(dst)
         else:
-            if not Path(dst).parent.exists():
-                self.__mkdir_local(str(Path(dst).parent))
-            with open(dst, 'wb') as fp:
-                fp.write(binascii.unhexlify(ret))
-                print(f'download {src} success')
+            ok = size is None or os.path.getsize(dst) == size
+        if not ok:
+            self._resume_get.pop(fqn, None)
+            raise PyboardError(f'verification of {dst} failed, auto try again.')
 
     def mget(self, dst_dir, pat, verbose=False):
         logging.info(f'mget {dst_dir} {pat}')
@@ -584,30 +1376,18 @@ class MpFileExplorer(Pyboard):
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
     def gets(self, src):
 
-        try:
-
-            self.exec_("f = open('%s', 'rb')" % self._fqn(src))
-            ret = self.exec_(
-                "while True:\r\n"
-                "  c = ubinascii.hexlify(f.read(%s))\r\n"
-                "  if not len(c):\r\n"
-                "    break\r\n"
-                "  sys.stdout.write(c)\r\n" % self.BIN_CHUNK_SIZE
-            )
-
-        except PyboardError as e:
-            if _was_file_not_existing(e):
-                raise RemoteIOError("Failed to read file: %s" % src)
-            else:
-                raise e
+        self._open_remote_read(src)
+        buffer = io.BytesIO()
+        self._stream_remote_read(buffer)
+        ret = buffer.getvalue()
 
         try:
 
-            return binascii.unhexlify(ret).decode("utf-8")
+            return ret.decode("utf-8")
 
         except UnicodeDecodeError:
 
-            s = ret.decode("utf-8")
+            s = binascii.hexlify(ret).decode("utf-8")
             fs = "\nBinary file:\n\n"
 
             while len(s):
@@ -616,6 +1396,31 @@ class MpFileExplorer(Pyboard):
 
             return fs
 
+    @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
+    def cat(self, src, out=None):
+        """
+        print remote file as it arrives
+        Args:
+            src: remote file path
+            out: text stream, sys.stdout by default
+
+        Returns:
+            None
+
+        """
+        out = out or sys.stdout
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        class _TextWriter:
+            @staticmethod
+            def write(data):
+                out.write(decoder.decode(data))
+                out.flush()
+
+        self._open_remote_read(src)
+        self._stream_remote_read(_TextWriter())
+        out.write(decoder.decode(b'', final=True))
+
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
     def cd(self, target):
         logging.info(f'cd {target}')
@@ -666,6 +1471,82 @@ class MpFileExplorer(Pyboard):
             else:
                 raise e
 
+    def rmrf(self, target, confirm=True):
+        """
+        remove a file or a folder and its content with one device side traversal
+        Args:
+            target: remote file/folder path
+            confirm: ask before deleting
+
+        Returns:
+            [(path, 'D' or 'F')] removed
+
+        """
+        content = f'Warnning: \nDelete {target}, Y/N:'
+        if confirm:
+            if_do = repeat_inquiry(content)
+            if not if_do:
+                return []
+        fqn = self._fqn(target)
+        logging.info(f'rmrf {fqn}')
+        print(f'rm {target}')
+
+        ret, ret_err = self.exec_raw("_mpf_rmrf('%s')" % fqn)
+        removed = parse_removed(ret)
+        for path, _ in removed:
+            print(f" * rm {path}")
+        # what was removed before an error is gone from the board too
+        removed_files = [path for path, node_type in removed if node_type == 'F']
+        self._record_sign(self.md5_varifier.rm_signs(removed_files), removed_files)
+
+        if ret_err:
+            if not removed and _was_file_not_existing(ret_err):
+                raise RemoteIOError("No such file or directory: %s" % fqn)
+            raise PyboardError('exception', ret, ret_err)
+        return removed
+
+    def mrmrf(self, pat: str):
+        logging.info(f'mrmrf {self.dir} {pat}')
+
+        try:
+
+            files = self.ls(add_details=True)
+            find = re.compile(pat)
+
+            with self.sign_batch():
+                for f in files:
+                    file_name, file_type = f
+                    if find.match(file_name):
+                        self.rmrf(file_name)
+        except sre_constants.error as e:
+            raise RemoteIOError("Error in regular expression: %s" % e)
+        except Exception as e:
+            logging.error(e)
+            raise e
+
+    def synchronize(self, local_dir_path, remote_dir_path):
+        """
+        同步本地文件夹和开发板上文件夹，删除开发板上本地没有的文件和文件夹
+        Args:
+            local_dir_path:
+            remote_dir_path:
+
+        Returns:
+
+        """
+        remote_root = self._fqn(remote_dir_path)
+        try:
+            nodes = self.walk(remote_dir_path)
+        except RemoteIOError as e:
+            logging.warning(e)
+            return
+        # reversed walk: the content of a folder comes before the folder
+        with self.sign_batch():
+            for path, node_type, _, _ in reversed(nodes[1:]):
+                local = os.path.join(local_dir_path, *posixpath.relpath(path, remote_root).split('/'))
+                if not (os.path.isdir(local) if node_type == 'D' else os.path.isfile(local)):
+                    self.rm(path)
+
     def mpy_cross(self, src, dst=None):
         logging.info('do mpy cross')
 
@@ -680,166 +1561,101 @@ class MpFileExplorer(Pyboard):
 
 class MpFileExplorerCaching(MpFileExplorer):
 
+    CACHE_FILE = 'listing_cache.json'  # in the mpfshell home path, shared by all boards
+
     def __init__(self, constr, reset=False):
         MpFileExplorer.__init__(self, constr, reset)
 
-        self.cache = {}
-
-    def __cache(self, path, data):
-
-        data = list(set(data))
-        logging.debug("caching '%s': %s" % (path, data))
-        self.cache[path] = data
+        self.cache = DirCache()
+        self._store = ListingStore(os.path.join(init_home_path(), self.CACHE_FILE))
+        self._device_id = self.device_id()
+        if self._device_id:
+            fingerprint = self.__fingerprint()
+            if fingerprint:
+                self.cache.load(self._store.load(self._device_id, fingerprint))
 
-    def __cache_hit(self, path):
+    def __del__(self):
 
-        return self.cache.get(path)
+        # saving needs the raw repl, which is gone by then, close() saves
+        self._device_id = None
+        MpFileExplorer.__del__(self)
 
-    def __update_cache(self, target: str, type: str, file_type='file'):
-        """
-        update __cache after option
-        Args:
-            target: dir/file
-            type: option type(rm/add)
-            file_type: file or dir
+    def close(self):
 
-        Returns:
+        self.__save_cache()
+        MpFileExplorer.close(self)
 
-        """
-        path = posixpath.split(self._fqn(target))
-        opt_item = path[-1]
-        parent = path[:-1][0]
-
-        hit = self.__cache_hit(parent)
-        if hit is not None and type == 'add' and file_type == 'file':
-            if not (target, 'F') in hit:
-                self.__cache(parent, hit + [(opt_item, 'F')])
-        elif hit is not None and type == 'add' and file_type == 'dir':
-            if not (dir, 'D') in hit:
-                self.__cache(parent, hit + [(opt_item, 'D')])
-        elif hit is not None and type == 'rm':
-            files = []
-            for f in hit:
-                if f[0] != opt_item:
-                    files.append(f)
-            self.__cache(parent, files)
-
-    def __rm_dir_remote(self, file_name):
-        ori_dir = self.dir
-        self.cd(file_name)
-        child_files = self.ls(add_details=True)
-        for file_ in child_files:
-            file_name, file_type = file_
-            if file_type == 'D':
-                self.__rm_dir_remote(file_name)
-                self.rm(file_name)
-            elif file_type == 'F':
-                self.rm(file_name)
-        self.dir = ori_dir
+    def __fingerprint(self):
+        """digest of the root listing and the free blocks, changes with almost any write on the board"""
+        try:
+            ret = self.exec_("_mpf_ls('/')\r\nprint(%s.statvfs('/'))" % self._os_lib)
+        except PyboardError as e:
+            logging.warning(f'Failed to fingerprint the file system, listings are not persisted: {e}')
+            return None
+        return hashlib.sha256(ret).hexdigest()
+
+    def __save_cache(self):
+        """persist the listings for the next session, once"""
+        device_id, self._device_id = self._device_id, None
+        if not device_id:
+            return
+        try:
+            fingerprint = self.__fingerprint()
+            if fingerprint:
+                self._store.save(device_id, fingerprint, self.cache.listings())
+        except (PyboardError, Exception) as e:
+            logging.warning(f'Failed to save the listing cache: {e}')
 
     def ls(self, add_files=True, add_dirs=True, add_details=False):
 
-        hit = self.__cache_hit(self.dir)
-
-        if hit is not None:
-
-            files = set()
-
-            if add_dirs:
-                for f in hit:
-                    if f[1] == 'D':
-                        if add_details:
-                            files.add(f)
-                        else:
-                            files.add(f[0])
-
-            if add_files:
-                for f in hit:
-                    if f[1] == 'F':
-                        if add_details:
-                            files.add(f)
-                        else:
-                            files.add(f[0])
-
-            return files
-
-        files = MpFileExplorer.ls(self, add_files, add_dirs, add_details)
-
-        self.__cache(self.dir, files)
+        hit = self.cache.get(self.dir)
+        if hit is None:
+            # cache the complete listing, the requested part is filtered from it
+            hit = MpFileExplorer.ls(self, add_details=True)
+            logging.debug("caching '%s': %s" % (self.dir, hit))
+            self.cache.put(self.dir, hit)
 
+        files = set()
+        for name, file_type in hit:
+            if (file_type == 'D' and add_dirs) or (file_type == 'F' and add_files):
+                files.add((name, file_type) if add_details else name)
         return files
 
-    def put(self, src, dst, verbose=True):
+    def put(self, src, dst, verbose=True, verify=False):
         logging.info(f'src: {src}')
         logging.info(f'dst: {dst}')
 
-        MpFileExplorer.put(self, src, dst, verbose=verbose)
+        MpFileExplorer.put(self, src, dst, verbose=verbose, verify=verify)
+
+        self.cache.add(self._fqn(dst), 'D' if os.path.isdir(src) else 'F')
+
+    def put_tree(self, src, dst, verbose=False, varify=True, verify=False):
 
-        self.__update_cache(dst, 'add', 'file')
+        written = MpFileExplorer.put_tree(self, src, dst, verbose=verbose, varify=varify, verify=verify)
+
+        self.cache.add(self._fqn(dst), 'D')
+        self.cache.invalidate(self._fqn(dst))
+        return written
 
     def md(self, dir_, varify=True):
 
         MpFileExplorer.md(self, dir_, varify)
-        self.__update_cache(dir_, 'add', 'dir')
+        self.cache.add(self._fqn(dir_), 'D')
 
     def rm(self, target):
 
         MpFileExplorer.rm(self, target)
-        self.__update_cache(target, 'rm')
+        self.cache.remove(self._fqn(target))
 
     def rmrf(self, target, confirm=True):
-        """remove directories and their contents recursively"""
-        content = f'Warnning: \nDelete {target}, Y/N:'
-        if confirm:
-            if_do = repeat_inquiry(content)
-            if not if_do:
-                return
-        files = self.ls(add_details=True)
-        print(f'rm {target}')
-
-        for file_ in files:
-            file_name, file_type = file_
-            if target == file_name:
-                if file_type == 'D':
-                    self.__rm_dir_remote(file_name)
-                    self.rm(file_name)
-                elif file_type == 'F':
-                    self.rm(file_name)
-
-    def mrmrf(self, pat: str):
-        logging.info(f'mrmrf {self.dir} {pat}')
 
+        fqn = self._fqn(target)
         try:
-
-            files = self.ls(add_details=True)
-            find = re.compile(pat)
-
-            for f in files:
-                file_name, file_type = f
-                if find.match(file_name):
-                    self.rmrf(file_name)
-        except sre_constants.error as e:
-            raise RemoteIOError("Error in regular expression: %s" % e)
-        except Exception as e:
-            logging.error(e)
+            removed = MpFileExplorer.rmrf(self, target, confirm)
+        except BaseException as e:
+            # part of the tree may be gone
+            self.cache.invalidate(posixpath.dirname(fqn))
             raise e
-
-    def synchronize(self, local_dir_path, remote_dir_path):
-        """
-        同步本地文件夹和开发板上文件夹
-        Args:
-            local_dir_path:
-            remote_dir_path:
-
-        Returns:
-
-        """
-        remote_path_suffix = f'{self.dir}{remote_dir_path}' if self.dir.endswith('/') \
-            else f'{self.dir}/{remote_dir_path}'
-        local_files = Path(local_dir_path).rglob('*')
-        remote_files = self.md5_varifier.get_filename_by_suffix(remote_path_suffix)
-        relative_files_local = [file.relative_to(local_dir_path) for file in local_files if file.is_file()]
-        relative_files_remote = {Path(file).relative_to(remote_path_suffix):file for file in remote_files}
-        for remote_file in relative_files_remote:
-            if remote_file not in relative_files_local:
-                self.rm(relative_files_remote[remote_file])
+        if removed:
+            self.cache.remove(fqn)
+        return removed
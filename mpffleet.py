@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet mode: the same shell commands on many boards at once, one MpFileShell session per board
+in a bounded pool of threads. The output of every board is collected and printed in one block
+when it finishes, followed by a summary of all boards.
+"""
+
+import fnmatch
+import glob
+import io
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial.tools.list_ports
+
+from pyboard import PyboardError
+
+
+class ThreadOutput:
+    """
+    sys.stdout replacement, what a thread prints after capture() goes to its own buffer,
+    other threads print to the stream as before
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def capture(self, buffer=None):
+        """print of this thread to buffer from now on, a new StringIO if None"""
+        self._local.buffer = buffer if buffer is not None else io.StringIO()
+
+    def release(self) -> str:
+        buffer = getattr(self._local, 'buffer', None)
+        self._local.buffer = None
+        return buffer.getvalue() if isinstance(buffer, io.StringIO) else ''
+
+    def write(self, data):
+        buffer = getattr(self._local, 'buffer', None)
+        return (buffer if buffer is not None else self._stream).write(data)
+
+    def flush(self):
+        if getattr(self._local, 'buffer', None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class BoardResult:
+    __slots__ = ('target', 'ok', 'error', 'duration', 'tx', 'rx', 'output')
+
+    def __init__(self, target):
+        self.target = target
+        self.ok = False
+        self.error = None
+        self.duration = 0.0
+        self.tx = 0
+        self.rx = 0
+        self.output = ''
+
+    @property
+    def rate(self):
+        """bytes per second in both directions"""
+        return (self.tx + self.rx) / self.duration if self.duration else 0.0
+
+
+def expand_targets(spec) -> list:
+    """
+    Args:
+        spec: targets separated by ',' or spaces, serial ports may be globs such as
+              ser:/dev/ttyACM* or COM1? and match the ports found on this host
+
+    Returns:
+        open arguments, in the given order, without duplicates
+
+    """
+    targets = []
+    ports = [port.device for port in serial.tools.list_ports.comports()]
+    for item in spec.replace(',', ' ').split():
+        if not any(char in item for char in '*?['):
+            matched = [item]
+        else:
+            pattern = item[4:] if item.startswith('ser:') else item
+            matched = sorted(set(fnmatch.filter(ports, pattern)) | set(glob.glob(pattern)))
+            if not matched:
+                logging.warning(f'No port matches {item}')
+            matched = ['ser:' + port for port in matched]
+        targets.extend(target for target in matched if target not in targets)
+    return targets
+
+
+def _size(nbytes):
+    return '%.1fKB' % (nbytes / 1024)
+
+
+def format_summary(results, wall) -> str:
+    width = max([len(result.target) for result in results] + [6])
+    lines = ['%-*s  %-6s  %8s  %10s  %10s' % (width, 'board', 'status', 'time', 'sent', 'rate')]
+    for result in results:
+        lines.append('%-*s  %-6s  %7.1fs  %10s  %8s/s%s' % (
+            width, result.target, 'ok' if result.ok else 'failed', result.duration,
+            _size(result.tx), _size(result.rate), '' if result.ok else '  ' + str(result.error)))
+    failed = sum(not result.ok for result in results)
+    lines.append('%d boards, %d ok, %d failed, wall %.1fs (%.1fs summed)' % (
+        len(results), len(results) - failed, failed, wall, sum(result.duration for result in results)))
+    return '\n'.join(lines)
+
+
+def run_fleet(targets, commands, make_shell, workers=8) -> list:
+    """
+    run commands on every target, at most workers boards at once. A board that fails to open or
+    whose command fails does not stop the others
+    Args:
+        targets: open arguments, e.g. from expand_targets
+        commands: shell command lines run in order on each board
+        make_shell: callable returning a new, not connected MpFileShell
+        workers: boards served at the same time
+
+    Returns:
+        [BoardResult] in the order of targets
+
+    """
+    output = ThreadOutput(sys.stdout)
+    print_lock = threading.Lock()
+
+    def run_board(target):
+        result = BoardResult(target)
+        output.capture()
+        start = time.time()
+        shell = None
+        try:
+            shell = make_shell()
+            shell.do_open(target)
+            if shell.fe is None:
+                raise IOError(f'Failed to open: {target}')
+            for command in commands:
+                errors = shell.errors
+                shell.onecmd(command)
+                if shell.errors != errors:
+                    raise IOError(f'{command}: {shell.last_error}')
+            result.ok = True
+        except (Exception, PyboardError) as e:
+            logging.error(f'{target}: {e}')
+            result.error = e
+        finally:
+            if shell is not None and shell.fe is not None:
+                # the connection counts what passed, since the last reconnect if there was one
+                result.tx, result.rx = shell.fe.con.tx, shell.fe.con.rx
+            if shell is not None:
+                try:
+                    shell.do_close('')
+                except (Exception, PyboardError) as e:
+                    logging.error(f'{target}: {e}')
+            result.duration = time.time() - start
+            result.output = output.release()
+        with print_lock:
+            output.write(f'==== {target} ({"ok" if result.ok else "failed"}, {result.duration:.1f}s) ====\n')
+            output.write(result.output)
+            output.flush()
+        return result
+
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='mpf-fleet') as executor:
+            return list(executor.map(run_board, targets))
+    finally:
+        sys.stdout = output._stream
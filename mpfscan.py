@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Board discovery: scan opens the candidate serial ports at once, stops what runs on each board and
+asks its MicroPython for the board, firmware and free memory. What it finds is kept by USB serial
+number in ~/.mpfshell, so later sessions can tell the boards apart without probing them.
+"""
+
+import ast
+import errno
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial.tools.list_ports
+
+from conbase import ConError
+from conserial import ConSerial
+from pyboard import Pyboard, PyboardError
+from utility.cache import BoardStore
+from utility.file_util import init_home_path
+
+BOARDS_FILE = 'boards.json'
+SCAN_TIMEOUT = 2.0  # seconds a board has to answer each step of the probe
+SCAN_WORKERS = 16
+BUSY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EBUSY)  # the port is locked by another program
+
+# prints (os module, sysname, release, version, machine, free flash, total flash, free ram),
+# None for what the port does not provide
+PROBE_SOURCE = """\
+def _mpf_probe():
+    import gc
+    try:
+        import os
+        lib = 'os'
+    except ImportError:
+        import uos as os
+        lib = 'uos'
+    u = os.uname()
+    try:
+        s = os.statvfs('/')
+        flash = (s[0] * s[3], s[0] * s[2])
+    except Exception:
+        flash = (None, None)
+    gc.collect()
+    try:
+        ram = gc.mem_free()
+    except Exception:
+        ram = None
+    print(repr((lib, u[0], u[2], u[3], u[4]) + flash + (ram,)))
+_mpf_probe()
+del _mpf_probe
+"""
+
+
+class BoardInfo:
+    FIELDS = ('model', 'machine', 'firmware', 'os_lib', 'flash_free', 'flash_total', 'ram_free')
+    __slots__ = ('port', 'serial_number', 'description', 'error', 'cached', 'duration') + FIELDS
+
+    def __init__(self, port, serial_number=None, description=None):
+        self.port = port
+        self.serial_number = serial_number
+        self.description = description
+        self.error = None
+        self.cached = False  # fields come from an earlier scan
+        self.duration = 0.0
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def fields(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def update(self, fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields.get(field))
+
+
+def board_model(machine):
+    """model of the machine field of os.uname(), the name get_board_info reads from the banner"""
+    ret = re.search(r'MicroPython board with (\w+)', machine) or re.search(r'ESP module with (\w+)', machine)
+    if ret:
+        return ret.group(1)
+    return machine.rsplit(' with ', 1)[-1].strip() or None
+
+
+def probe(port, timeout=SCAN_TIMEOUT) -> dict:
+    """
+    Args:
+        port: serial device, e.g. /dev/ttyACM0
+
+    Returns:
+        {field of BoardInfo.FIELDS: value}
+
+    Raises:
+        ConError if the port does not open, 'in use' if another program holds it, PyboardError if no
+        MicroPython answers in time
+    """
+    try:
+        # never send ctrl-C to a board another program is talking to
+        con = ConSerial(port, exclusive=True)
+    except ConError as e:
+        if _port_busy(e):
+            raise ConError('in use')
+        raise
+    board = Pyboard(con)
+    try:
+        board.con.write(b'\r\x03\x03')  # ctrl-C: stop the running program
+        board.con.write(b'\r\x01')  # ctrl-A: enter raw REPL
+        data = board.read_until(1, b'raw REPL; CTRL-B to exit', timeout=timeout, max_recv=8000)
+        if not data.endswith(b'raw REPL; CTRL-B to exit'):
+            raise PyboardError('no MicroPython REPL')
+        ret, ret_err = board.exec_raw(PROBE_SOURCE, timeout=timeout)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+        board.exit_raw_repl()
+    finally:
+        board.close()
+
+    lib, sysname, release, version, machine, flash_free, flash_total, ram_free = \
+        ast.literal_eval(ret.decode('utf-8').strip())
+    return {
+        'model': board_model(machine),
+        'machine': machine,
+        'firmware': f'{sysname} {release} ({version})',
+        'os_lib': lib,
+        'flash_free': flash_free,
+        'flash_total': flash_total,
+        'ram_free': ram_free,
+    }
+
+
+def _port_busy(e) -> bool:
+    """ConError of ConSerial caused by another program holding the port"""
+    cause = e.args[0] if e.args else e
+    # windows opens ports exclusively and denies the access to a second program
+    return getattr(cause, 'errno', None) in BUSY_ERRNOS or 'Access is denied' in str(cause)
+
+
+def scan(all_ports=False, timeout=SCAN_TIMEOUT, busy=(), cached_only=False, workers=SCAN_WORKERS) -> list:
+    """
+    probe the serial ports in parallel, boards with a USB serial number are stored for later sessions
+    Args:
+        all_ports: also probe ports without USB ids, such as the legacy /dev/ttyS*
+        busy: devices in use, e.g. the port open in the shell, shown from the store instead of probed
+        cached_only: probe no port, show what earlier scans found
+
+    Returns:
+        [BoardInfo] sorted by port
+    """
+    store = _store()
+    known = store.load()
+    infos = [BoardInfo(port.device, port.serial_number, port.description)
+             for port in sorted(serial.tools.list_ports.comports(), key=lambda port: port.device)
+             if all_ports or port.vid is not None]
+
+    def run(info):
+        if cached_only or info.port in busy:
+            if info.serial_number in known:
+                info.update(known[info.serial_number])
+                info.cached = True
+            else:
+                info.error = 'in use' if info.port in busy else 'not scanned yet'
+            return info
+        start = time.time()
+        try:
+            info.update(probe(info.port, timeout))
+        except (Exception, PyboardError) as e:
+            logging.info(f'scan {info.port}: {e}')
+            info.error = str(e) or type(e).__name__
+        info.duration = time.time() - start
+        return info
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(infos))), thread_name_prefix='mpf-scan') as executor:
+        infos = list(executor.map(run, infos))
+
+    found = {info.serial_number: info.fields() for info in infos
+             if info.serial_number and not info.cached and info.error is None}
+    if found:
+        store.save(found)
+    return infos
+
+
+def _store():
+    return BoardStore(os.path.join(init_home_path(), BOARDS_FILE))
+
+
+def known_boards() -> dict:
+    """{USB serial number: {field: value}} of the boards found by earlier scans"""
+    return _store().load()
+
+
+def _size(nbytes):
+    return '-' if nbytes is None else '%dKB' % (nbytes // 1024)
+
+
+def format_boards(infos) -> str:
+    rows = [('port', 'model', 'firmware', 'os', 'flash free', 'ram free', 'serial number', '')]
+    for info in infos:
+        if info.error is not None and not info.cached:
+            rows.append((info.port, '-', '-', '-', '-', '-', info.serial_number or '-', info.error))
+            continue
+        flash = _size(info.flash_free) + ('/' + _size(info.flash_total) if info.flash_total is not None else '')
+        rows.append((info.port, info.model or '-', info.firmware or '-', info.os_lib or '-', flash,
+                     _size(info.ram_free), info.serial_number or '-',
+                     'from an earlier scan' if info.cached else '%.1fs' % info.duration))
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]) - 1)]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) + '  ' + row[-1]
+                     for row in rows)
@@ -33,6 +33,7 @@ import serial
 import logging
 import platform
 import re
+import threading
 import time
 import json
 from pathlib import Path
@@ -41,6 +42,8 @@ import version
 from mpfexp import MpFileExplorer
 from mpfexp import MpFileExplorerCaching
 from mpfexp import RemoteIOError
+from mpffleet import expand_targets, format_summary, run_fleet
+from mpfscan import SCAN_TIMEOUT, format_boards, known_boards, scan
 from pyboard import PyboardError
 from conbase import ConError
 from tokenizer import Tokenizer
@@ -51,13 +54,18 @@ from utility.utils import trim_code_block
 class MpFileShell(cmd.Cmd):
 
     STATE_FILE = 'state_temp.json'
+    FLEET_WORKERS = 8  # boards served at once by fleet
+    _state_lock = threading.Lock()  # fleet sessions update STATE_FILE from several threads
 
-    def __init__(self, color=False, caching=False, reset=False, help=False):
+    def __init__(self, color=False, caching=False, reset=False, help=False, verify=False):
         cmd.Cmd.__init__(self)
 
         self.color = color
         self.caching = caching
         self.reset = reset
+        self.verify = verify  # confirm uploads by the digests computed on the board
+        self.errors = 0  # errors reported by commands, fleet tells failed boards by it
+        self.last_error = None
         self.open_args = None
         self.fe = None
         self.repl = None
@@ -108,6 +116,8 @@ class MpFileShell(cmd.Cmd):
 
     def __error(self, msg):
 
+        self.errors += 1
+        self.last_error = msg
         print('\n' + msg + '\n')
 
     def __connect(self, port, reconnect=False):
@@ -183,14 +193,15 @@ class MpFileShell(cmd.Cmd):
 
     def __update_state(self, file_name=STATE_FILE, state='mpfshell'):
         state = {self.port: state}
-        if os.path.exists(file_name):
-            with open(file_name, 'r') as fp:
-                state_intact = json.load(fp)
-            state_intact.update(state)
-        else:
-            state_intact = state
-        with open(file_name, 'w') as fp:
-            json.dump(state_intact, fp, indent=4)
+        with self._state_lock:
+            if os.path.exists(file_name):
+                with open(file_name, 'r') as fp:
+                    state_intact = json.load(fp)
+                state_intact.update(state)
+            else:
+                state_intact = state
+            with open(file_name, 'w') as fp:
+                json.dump(state_intact, fp, indent=4)
 
     def __parse_put_args(self, args):
         if not len(args):
@@ -268,8 +279,14 @@ class MpFileShell(cmd.Cmd):
         if len(plist) <= 0:
             print("serial not found!")
         else:
+            boards = known_boards()
             for serial in plist:
-                print("serial name :", serial[1], " : ", serial[0].split('/')[-1])
+                board = boards.get(serial.serial_number) if serial.serial_number else None
+                if board:
+                    print("serial name :", serial[1], " : ", serial[0].split('/')[-1], " : ", board.get('model'),
+                          board.get('firmware'))
+                else:
+                    print("serial name :", serial[1], " : ", serial[0].split('/')[-1])
 
         if self.open_args:
             print("current open_args", self.open_args)
@@ -311,17 +328,7 @@ class MpFileShell(cmd.Cmd):
         if not len(args):
             self.__error("Missing argument: <PORT>")
         else:
-            if not args.startswith("ser:/dev/") \
-                    and not args.startswith("ser:COM") \
-                    and not args.startswith("tn:") \
-                    and not args.startswith("ws:"):
-
-                if platform.system() == "Windows":
-                    args = "ser:" + args
-                elif '/dev' in args:
-                    args = "ser:" + args
-                else:
-                    args = "ser:/dev/" + args
+            args = self.normalize_target(args)
 
             self.open_args = args
             self.port = args
@@ -329,6 +336,23 @@ class MpFileShell(cmd.Cmd):
             self.__connect(args)
             self.__update_state()
 
+    @staticmethod
+    def normalize_target(args):
+        """open argument as a full target, e.g. ttyUSB0 -> ser:/dev/ttyUSB0"""
+
+        if not args.startswith("ser:/dev/") \
+                and not args.startswith("ser:COM") \
+                and not args.startswith("tn:") \
+                and not args.startswith("ws:"):
+
+            if platform.system() == "Windows":
+                args = "ser:" + args
+            elif '/dev' in args:
+                args = "ser:" + args
+            else:
+                args = "ser:/dev/" + args
+        return args
+
     def complete_open(self, *args):
         ports = glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*')
         return [i[5:] for i in ports if i[5:].startswith(args[0])]
@@ -366,7 +390,7 @@ class MpFileShell(cmd.Cmd):
                     if type == 'D':
                         print(" <dir> %s" % elem)
                     else:
-                        print(" <file/empty_dir> %s" % elem)
+                        print(" <file> %s" % elem)
 
                 print("")
 
@@ -375,6 +399,26 @@ class MpFileShell(cmd.Cmd):
             except Exception as e:
                 print(e)
 
+    def do_cache(self, args):
+        """cache [clear]
+        Show the hit and miss counters of the remote directory cache, or clear it.
+        """
+        if self.__is_open():
+            if not isinstance(self.fe, MpFileExplorerCaching):
+                self.__error("Cache is disabled (--nocache)")
+                return
+            if args.strip() == 'clear':
+                self.fe.cache.clear()
+                print('Cache cleared')
+                return
+            elif args.strip():
+                self.__error("Unknown argument: %s" % args.strip())
+                return
+            stats = self.fe.cache.stats()
+            print("dirs: %d/%d, hits: %d, misses: %d, hit rate: %.1f%%, evictions: %d" % (
+                stats['dirs'], stats['max_dirs'], stats['hits'], stats['misses'], stats['hit_rate'] * 100,
+                stats['evictions']))
+
     def do_pwd(self, args):
         """pwd
          Print current remote directory.
@@ -484,21 +528,6 @@ class MpFileShell(cmd.Cmd):
 
         print(os.getcwd())
 
-    def __put_dir(self, src, dst, varify=True):
-        remote = self.fe.pwd()
-        try:
-            try:
-                self.fe.md(dst, varify=varify)
-            except Exception as e:
-                pass
-            self.fe.cd(dst)
-        except Exception as e:
-            logging.error(e)
-        for f in Path(src).rglob('*'):
-            if f.is_dir():
-                self.fe.md(str(f.absolute())[len(src)+1:], varify=False)
-        self.fe.cd(remote)
-
     def _do_put(self, lfile_name, work_path, rfile_name, varify=True, verbose=True):
         """
 
@@ -513,25 +542,15 @@ class MpFileShell(cmd.Cmd):
         logging.warning(f'do put {lfile_name} {work_path} {rfile_name}')
         try:
             if os.path.isdir(lfile_name):
-                self.__put_dir(lfile_name, rfile_name, varify=varify)
-                files = [str(f.absolute()) for f in Path(lfile_name).rglob('*') if f.is_file()]
-                nums = len(files)
-                num_cur = 1
-                for file in files:
-                    relative_path = file[len(work_path) + 1:]
-                    remote_relative_path = relative_path.replace(lfile_name[len(work_path) + 1:], rfile_name)
-                    file_size = get_file_size(file)
-                    if verbose:
-                        print(f'[{num_cur}/{nums}] Writing file {relative_path}({file_size // 1024 + 1}kb)')
-                    self.fe.put(str(file), remote_relative_path, verbose=not verbose)
-                    num_cur += 1
+                self.fe.put_tree(lfile_name, rfile_name, verbose=verbose, varify=varify, verify=self.verify)
                 if verbose:
                     print('Upload done')
             elif os.path.isfile(lfile_name):
                 file_size = get_file_size(lfile_name)
                 if verbose:
-                    print(f'[1/1] Writing file {lfile_name[len(work_path) + 1:]}({file_size // 1024 + 1}kb)')
-                self.fe.put(lfile_name, rfile_name, verbose=not verbose)
+                    name = lfile_name[len(work_path) + 1:] if work_path else rfile_name
+                    print(f'[1/1] Writing file {name}({file_size // 1024 + 1}kb)')
+                self.fe.put(lfile_name, rfile_name, verbose=not verbose, verify=self.verify)
                 if verbose:
                     print('Upload done')
             else:
@@ -582,14 +601,15 @@ class MpFileShell(cmd.Cmd):
 
             files = Path(work_path).glob('*')
             compiler = re.compile(pattern)
-            for file in files:
-                if compiler.match(str(file)):
-                    if remote_path is None:
-                        rfile_name = file.name
-                    else:
-                        rfile_name = remote_path
-                        rfile_name = f'{rfile_name}/{file.name}'
-                    self._do_put(str(file.absolute()), work_path, rfile_name, varify=False)
+            with self.fe.sign_batch():
+                for file in files:
+                    if compiler.match(str(file)):
+                        if remote_path is None:
+                            rfile_name = file.name
+                        else:
+                            rfile_name = remote_path
+                            rfile_name = f'{rfile_name}/{file.name}'
+                        self._do_put(str(file.absolute()), work_path, rfile_name, varify=False)
 
     def do_get(self, args):
         """get <REMOTE FILE> [<LOCAL FILE>]
@@ -734,7 +754,8 @@ class MpFileShell(cmd.Cmd):
                 return
 
             try:
-                print(self.fe.gets(s_args[0]))
+                self.fe.cat(s_args[0])
+                print("")
             except IOError as e:
                 self.__error(str(e))
             except Exception as e:
@@ -902,11 +923,17 @@ class MpFileShell(cmd.Cmd):
                 if args != None:
                     self.fe.con.write(bytes(args, encoding="utf8"))
                 self.repl.join(True)
+                if hasattr(self.fe.con, 'cancel_read'):
+                    # stop the receiver too, or it takes the first reply meant for the shell
+                    self.repl.join()
             except Exception as e:
                 # print(e)
                 pass
 
             self.repl.console.cleanup()
+            if hasattr(self.fe.con, 'reset_cancel'):
+                # the receiver may have stopped without reading, the cancel must not cut short a read of setup
+                self.fe.con.reset_cancel()
 
             self.fe.setup()
             self.__update_state(state='mpfshell')
@@ -994,10 +1021,135 @@ class MpFileShell(cmd.Cmd):
         put_args = self.__parse_put_args(args)
         if put_args:
             lfile_name, work_path, rfile_name = put_args
-            self._do_put(lfile_name, work_path, rfile_name, verbose=False)
-            self.fe.synchronize(lfile_name, rfile_name)
+            with self.fe.sign_batch():
+                self._do_put(lfile_name, work_path, rfile_name, verbose=False)
+                self.fe.synchronize(lfile_name, rfile_name)
             print('Synchronize done\n')
 
+    def do_scan(self, args):
+        """scan [-a] [-c] [-t <SECONDS>]
+        Find the MicroPython boards on the USB serial ports. All ports are probed
+        at once and show model, firmware, os or uos, free flash and free RAM.
+        Boards are remembered by USB serial number, 'view' shows them too.
+        Probing stops the program running on a board and leaves it in the REPL,
+        the port open in this shell is not probed.
+        -a  also probe the ports without USB ids, e.g. /dev/ttyS*
+        -c  probe nothing, show what earlier scans found
+        -t  seconds a board has to answer, default 2
+        """
+
+        all_ports = cached_only = False
+        timeout = SCAN_TIMEOUT
+        tokens = args.split()
+        while tokens:
+            token = tokens.pop(0)
+            if token == '-a':
+                all_ports = True
+            elif token == '-c':
+                cached_only = True
+            elif token == '-t' and tokens:
+                try:
+                    timeout = float(tokens.pop(0))
+                except ValueError:
+                    self.__error("Invalid timeout: -t <SECONDS>")
+                    return
+            else:
+                self.__error("Unknown argument: %s" % token)
+                return
+
+        busy = ()
+        if self.fe is not None and self.open_args and self.open_args.startswith('ser:'):
+            busy = (self.open_args[len('ser:'):],)
+        start = time.time()
+        infos = scan(all_ports, timeout, busy, cached_only)
+        if not infos:
+            print("serial not found!")
+            return
+        print(format_boards(infos))
+        found = sum(info.error is None for info in infos)
+        print("%d ports, %d boards in %.1fs" % (len(infos), found, time.time() - start))
+
+    def do_fleet(self, args):
+        """fleet [-j <WORKERS>] <TARGETS> <COMMAND>[; <COMMAND> ...]
+        Run the commands on many boards at once, each board in its own session,
+        and print a summary with the time and throughput of every board.
+        TARGETS are open targets separated by ',', serial ports may be globs,
+        e.g. ser:/dev/ttyACM* or COM1?,COM2?. Up to WORKERS boards (default 8)
+        are served at the same time. The current connection is not used.
+        """
+
+        match = re.match(r'\s*(?:-j\s*(\d+)\s+)?(\S+)\s+(.+)', args)
+        if not match:
+            self.__error("Missing arguments: [-j <WORKERS>] <TARGETS> <COMMAND>")
+            return
+        workers = int(match.group(1)) if match.group(1) else self.FLEET_WORKERS
+        self.fleet(match.group(2), match.group(3), workers)
+
+    def fleet(self, spec, command_line, workers=FLEET_WORKERS):
+        """
+        run command_line, commands separated by ';', on the boards of spec (see mpffleet.expand_targets)
+        """
+        targets = expand_targets(spec)
+        if not targets:
+            self.__error("No board matches %s" % spec)
+            return
+        commands = [command.strip() for command in command_line.split(';') if command.strip()]
+        print(f'Run on {len(targets)} boards, {min(workers, len(targets))} at once: {"; ".join(commands)}')
+        start = time.time()
+        results = run_fleet(targets, commands,
+                            lambda: MpFileShell(False, self.caching, self.reset, False, self.verify),
+                            workers=workers)
+        print(format_summary(results, time.time() - start))
+        if not all(result.ok for result in results):
+            self.errors += 1
+            self.last_error = 'fleet: some boards failed'
+
+
+def daemon_main(args):
+    """--daemon, --daemon-serve and --daemon-stop, returns the exit code"""
+
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        print("The daemon needs Unix domain sockets, not available on this system")
+        return 2
+    import mpfdaemon
+
+    socket_path = args.socket or mpfdaemon.default_socket_path()
+
+    if args.daemon_serve:
+        mpfdaemon.serve(socket_path,
+                        lambda caching, reset, verify: MpFileShell(False, caching, reset, False, verify),
+                        MpFileShell.normalize_target, args.idle_timeout)
+        return 0
+
+    if args.daemon_stop:
+        try:
+            return mpfdaemon.request(socket_path, {'stop': True})
+        except OSError:
+            print("No daemon running")
+            return 0
+
+    commands = [cmd.strip() for cmd in ' '.join(args.command or []).split(';')]
+    commands = [cmd for cmd in commands if len(cmd) > 0 and not cmd.startswith('#')]
+    target = args.board or args.open
+    if commands and commands[0].split()[0] in ('open', 'o'):
+        target = commands.pop(0).split(None, 1)[-1]
+    if target in (None, 'open', 'o'):
+        print("--daemon needs the board, given with -o or a first 'open <TARGET>' command")
+        return 2
+
+    spawn_args = ['--loglevel', args.loglevel]
+    if args.logfile is not None:
+        spawn_args += ['--logfile', os.path.abspath(args.logfile)]
+    message = {'target': target, 'commands': commands, 'cwd': os.getcwd(), 'caching': not args.nocache,
+               'reset': args.reset, 'verify': args.verify}
+    try:
+        return mpfdaemon.request(socket_path, message,
+                                 autostart=lambda: mpfdaemon.spawn(socket_path, args.idle_timeout, spawn_args))
+    except OSError as e:
+        print("Failed to reach the daemon: %s" % e)
+        return 1
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -1009,6 +1161,8 @@ def main():
     parser.add_argument("--nocolor", help="disable color", action="store_true", default=False)
     parser.add_argument("--nocache", help="disable cache", action="store_true", default=False)
     parser.add_argument("--nohelp", help="disable help", action="store_true", default=False)
+    parser.add_argument("--verify", help="check uploaded files against the digests computed on the board",
+                        action="store_true", default=False)
 
     parser.add_argument("--logfile", help="write log to file", default=None)
     parser.add_argument("--loglevel", help="loglevel (CRITICAL, ERROR, WARNING, INFO, DEBUG)", default="INFO")
@@ -1017,6 +1171,19 @@ def main():
                         default=False)
 
     parser.add_argument("-o", "--open", help="directly opens board", metavar="BOARD", action="store", default=None)
+    parser.add_argument("--fleet", help="run the commands of -c on all these boards at once, e.g. 'ser:/dev/ttyACM*'",
+                        metavar="TARGETS", action="store", default=None)
+    parser.add_argument("--workers", help="boards served at once in fleet mode", type=int,
+                        default=MpFileShell.FLEET_WORKERS)
+    parser.add_argument("--daemon", help="run the commands of -c in a background daemon that keeps the board "
+                                         "connected between calls, started when none runs", action="store_true",
+                        default=False)
+    parser.add_argument("--daemon-serve", help="run the daemon in the foreground", action="store_true", default=False)
+    parser.add_argument("--daemon-stop", help="close all sessions of the daemon and stop it", action="store_true",
+                        default=False)
+    parser.add_argument("--socket", help="socket of the daemon, default ~/.mpfshell/daemon.sock", default=None)
+    parser.add_argument("--idle-timeout", help="seconds the daemon keeps an unused board connected", type=int,
+                        default=300)
     parser.add_argument("board", help="directly opens board", nargs="?", action="store", default=None)
 
     args = parser.parse_args()
@@ -1032,7 +1199,10 @@ def main():
     logging.info('Running on Python %d.%d using PySerial %s' \
                  % (sys.version_info[0], sys.version_info[1], serial.VERSION))
 
-    mpfs = MpFileShell(not args.nocolor, not args.nocache, args.reset, args.nohelp)
+    if args.daemon or args.daemon_serve or args.daemon_stop:
+        sys.exit(daemon_main(args))
+
+    mpfs = MpFileShell(not args.nocolor, not args.nocache, args.reset, args.nohelp, args.verify)
 
     if args.open is not None:
         if args.board is None:
@@ -1042,7 +1212,14 @@ def main():
     if args.board is not None:
         mpfs.do_open(args.board)
 
-    if args.command is not None:
+    if args.fleet is not None:
+
+        if args.command is None:
+            print("--fleet needs the commands to run, given with -c")
+        else:
+            mpfs.fleet(args.fleet, ' '.join(args.command), args.workers)
+
+    elif args.command is not None:
 
         for cmd in ' '.join(args.command).split(';'):
             scmd = cmd.strip()
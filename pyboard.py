@@ -7,7 +7,9 @@ Pyboard REPL interface
 import sys
 import re
 import time
+import struct
 import logging
+import collections
 
 try:
     stdout = sys.stdout.buffer
@@ -26,40 +28,345 @@ class PyboardError(BaseException):
     pass
 
 
+class PyboardPipelineError(PyboardError):
+    """a command of exec_pipelined failed, index is its position among the commands"""
+
+    def __init__(self, index, *args):
+        PyboardError.__init__(self, *args)
+        self.index = index
+
+
+class Write:
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Read:
+    """read size bytes, fewer on timeout"""
+    __slots__ = ('size',)
+
+    def __init__(self, size):
+        self.size = size
+
+
+class ReadUntil:
+    """arguments of Pyboard.read_until"""
+    __slots__ = ('ending', 'timeout', 'data_consumer', 'max_recv', 'keep_data')
+
+    def __init__(self, ending, timeout=10, data_consumer=None, max_recv=sys.maxsize, keep_data=True):
+        self.ending = ending
+        self.timeout = timeout
+        self.data_consumer = data_consumer
+        self.max_recv = max_recv
+        self.keep_data = keep_data
+
+
+class InWaiting:
+    """number of bytes received and not read yet"""
+    __slots__ = ()
+
+
+class Sleep:
+    __slots__ = ('seconds',)
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class RawRepl:
+    """
+    The raw REPL protocol without the I/O. Every step is a generator that yields Write, Read, ReadUntil,
+    InWaiting and Sleep requests and is sent the result of each, its return value is the result of
+    the step. Pyboard runs the steps on a blocking connection, mpfasync.AsyncPyboard on an asyncio one.
+    """
+
+    def __init__(self):
+        self.use_raw_paste = False
+
+    def enter(self):
+        # waiting any board boot start and enter micropython
+        for i in range(8):
+            yield Sleep(0.1)
+            yield Write(b'\x03\x03\x03\x03')
+            yield Sleep(0.1)
+            yield Write(b'\x02\x02\x02\x02')
+            yield Sleep(0.1)
+
+            data = yield ReadUntil(b'>>>', timeout=5, max_recv=8000)
+            if not data.endswith(b'>>>'):
+                # print(data)
+                print('Could not enter raw repl, Press Reset key after 10 seconds.')
+            else:
+                break
+
+        # flush input (without relying on serial.flushInput())
+        n = yield InWaiting()
+        while n > 0:
+            yield Read(n)
+            n = yield InWaiting()
+
+        yield Write(b'\r\x01')  # ctrl-A: enter raw REPL
+        data = yield ReadUntil(b'raw REPL; CTRL-B to exit', max_recv=8000)
+        if not data.endswith(b'raw REPL; CTRL-B to exit'):
+            # print(data)
+            raise PyboardError('could not enter raw repl')
+
+        self.use_raw_paste = yield from self.probe_raw_paste()
+        logging.info(f'raw paste mode supported: {self.use_raw_paste}')
+
+    def probe_raw_paste(self):
+        """
+        negotiate raw-paste mode with the board, leaving exactly one '>' prompt pending
+        Returns:
+            True if the firmware supports raw-paste mode
+
+        """
+        data = yield ReadUntil(b'>')
+        if not data.endswith(b'>'):
+            return False
+
+        yield Write(b'\x05A\x01')
+        data = yield Read(2)
+        if data == b'R\x01':
+            # the board is in raw-paste mode now, finish it with an empty command
+            yield Read(2)
+            yield Write(b'\x04')
+            yield ReadUntil(b'\x04')
+            yield from self.follow(timeout=4)
+            return True
+        if data == b'R\x00':
+            # the firmware has no raw-paste mode and waits for a command without a new prompt,
+            # ctrl-A restarts the raw REPL for one
+            yield Write(b'\x01')
+            yield ReadUntil(b'raw REPL; CTRL-B to exit\r\n')
+        # old firmware took the b'\x01' as ctrl-A and restarted the raw REPL, its prompt is pending too
+        return False
+
+    def follow(self, timeout, data_consumer=None, keep_data=True):
+
+        # wait for normal output
+        data = yield ReadUntil(b'\x04', timeout=timeout, data_consumer=data_consumer, keep_data=keep_data)
+        # print(data)
+        if not data.endswith(b'\x04') and not data.endswith(b'>'):
+            raise PyboardError('timeout waiting for first EOF reception')
+        data = data[:-1]
+
+        # wait for error output
+        data_err = yield ReadUntil(b'\x04', timeout=timeout)
+        # print(data_err)
+        if not data_err.endswith(b'\x04') and not data.endswith(b'>'):
+            raise PyboardError('timeout waiting for second EOF reception')
+        data_err = data_err[:-1]
+
+        # return normal and error output
+        return data, data_err
+
+    def raw_paste_write(self, command_bytes):
+        """
+        write command in raw-paste mode, the board grants window sized credits by b'\\x01'
+        Args:
+            command_bytes: bytes
+
+        Returns:
+            None
+
+        """
+        data = yield Read(2)
+        window_size = struct.unpack('<H', data)[0]
+        window_remain = window_size
+
+        i = 0
+        while i < len(command_bytes):
+            while window_remain == 0 or (yield InWaiting()) > 0:
+                data = yield Read(1)
+                if data == b'\x01':
+                    # the board can receive another window of data
+                    window_remain += window_size
+                elif data == b'\x04':
+                    # the board ended the transfer abruptly, acknowledge it
+                    yield Write(b'\x04')
+                    return
+                else:
+                    raise PyboardError(f'unexpected read during raw paste: {data}')
+            b = command_bytes[i:min(i + window_remain, len(command_bytes))]
+            yield Write(b)
+            window_remain -= len(b)
+            i += len(b)
+
+        # end of data, wait for the board to acknowledge it
+        yield Write(b'\x04')
+        data = yield ReadUntil(b'\x04')
+        if not data.endswith(b'\x04'):
+            raise PyboardError(f'could not complete raw paste: {data}')
+
+    def exec_raw_no_follow(self, command):
+
+        if isinstance(command, bytes):
+            command_bytes = command
+        else:
+            command_bytes = bytes(command.encode('utf-8'))
+
+        # check we have a prompt
+        data = yield ReadUntil(b'>')
+
+        if not data.endswith(b'>'):
+            raise PyboardError('could not enter raw repl, auto try again.')
+
+        if self.use_raw_paste:
+            yield Write(b'\x05A\x01')
+            data = yield Read(2)
+            if data == b'R\x01':
+                yield from self.raw_paste_write(command_bytes)
+                return
+            # the board refused raw-paste mode, use the normal raw REPL from now on
+            logging.warning(f'raw paste mode refused: {data}')
+            self.use_raw_paste = False
+            if data != b'R\x00':
+                # old firmware took the b'\x01' as ctrl-A and restarted the raw REPL
+                data = yield ReadUntil(b'>')
+                if not data.endswith(b'>'):
+                    raise PyboardError('could not enter raw repl, auto try again.')
+            # after 'R\x00' the board waits for the command, there is no new prompt
+
+        # write command
+        for i in range(0, len(command_bytes), 256):
+            yield Write(command_bytes[i:min(i + 256, len(command_bytes))])
+            yield Sleep(0.01)
+        yield Write(b'\x04')
+
+        # check if we could exec command
+        data = yield Read(2)
+        # print(data)
+        if b'OK' not in data:
+            raise PyboardError('could not exec command, auto try again.')
+
+    def exec_raw(self, command, timeout=4, data_consumer=None):
+        yield from self.exec_raw_no_follow(command)
+        return (yield from self.follow(timeout, data_consumer))
+
+    def exec_pipelined(self, commands, window=4, timeout=4, on_result=None):
+        """
+        execute independent commands with up to window of them sent before their results are read,
+        so a slow link costs one round trip per window instead of one per command. The commands are
+        sent in the normal raw REPL, raw-paste mode needs a handshake per command
+        Args:
+            commands: iterable of str/bytes, consumed lazily
+            window: max commands in flight, 1 is stop-and-wait through exec_raw
+            on_result: callable(index, output), called in command order for every command that succeeded
+
+        Returns:
+            number of commands executed
+
+        Raises:
+            PyboardPipelineError: for the first failed command, once the commands already in flight
+                are answered. No command is sent after it
+
+        """
+        if window <= 1:
+            index = 0
+            for index, command in enumerate(commands, 1):
+                ret, ret_err = yield from self.exec_raw(command, timeout)
+                if ret_err:
+                    raise PyboardPipelineError(index - 1, 'exception', ret, ret_err)
+                if on_result:
+                    on_result(index - 1, ret)
+            return index
+
+        commands = iter(commands)
+        in_flight = collections.deque()
+        sent = 0
+        exhausted = False
+        failed = None
+        while True:
+            while not exhausted and failed is None and len(in_flight) < window:
+                command = next(commands, None)
+                if command is None:
+                    exhausted = True
+                    break
+                if not isinstance(command, bytes):
+                    command = command.encode('utf-8')
+                logging.debug(f'pipeline command {sent}: {command}')
+                yield Write(command + b'\x04')
+                in_flight.append(sent)
+                sent += 1
+            if not in_flight:
+                break
+
+            # the board answers every command with '>' 'OK' output '\x04' error '\x04', in order
+            index = in_flight.popleft()
+            data = yield ReadUntil(b'>', timeout=timeout)
+            if not data.endswith(b'>'):
+                raise PyboardError('could not enter raw repl, auto try again.')
+            data = yield Read(2)
+            if b'OK' not in data:
+                raise PyboardError('could not exec command, auto try again.')
+            ret, ret_err = yield from self.follow(timeout)
+            if failed is not None:
+                continue
+            if ret_err:
+                failed = PyboardPipelineError(index, 'exception', ret, ret_err)
+            elif on_result:
+                on_result(index, ret)
+
+        if failed is not None:
+            raise failed
+        return sent
+
+
 class Pyboard:
 
     def __init__(self, conbase):
         logging.info('Init Pyboard')
 
         self.con = conbase
+        self.repl = RawRepl()
+
+    @property
+    def use_raw_paste(self):
+        return self.repl.use_raw_paste
+
+    @use_raw_paste.setter
+    def use_raw_paste(self, value):
+        self.repl.use_raw_paste = value
 
     def close(self):
 
         if self.con is not None:
             self.con.close()
 
-    def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None, max_recv=sys.maxsize):
+    def _run(self, step):
+        """run a RawRepl step on the connection, returns its result"""
+        try:
+            request = next(step)
+            while True:
+                if isinstance(request, ReadUntil):
+                    result = self.read_until(1, request.ending, timeout=request.timeout,
+                                             data_consumer=request.data_consumer, max_recv=request.max_recv,
+                                             keep_data=request.keep_data)
+                elif isinstance(request, Read):
+                    result = self.con.read(request.size)
+                elif isinstance(request, Write):
+                    result = self.con.write(request.data)
+                elif isinstance(request, InWaiting):
+                    result = self.con.inWaiting()
+                else:
+                    result = time.sleep(request.seconds)
+                request = step.send(result)
+        except StopIteration as e:
+            return e.value
+
+    def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None, max_recv=sys.maxsize,
+                   keep_data=True):
+        """
+        read until ending is received
+        Args:
+            keep_data: False to hand the data only to data_consumer, and return just the tail containing ending
+        """
 
-        data = self.con.read(min_num_bytes)
-        if data_consumer:
-            data_consumer(data)
-        timeout_count = 0
-        while len(data) < max_recv:
-            # print(len(data), data) # if main.py exist "while True:\r\nprint(1)\r\n lead to recv data error"
-    
-            if data.endswith(ending):
-                break
-            elif self.con.inWaiting() > 0:
-                new_data = self.con.read(1)
-                data = data + new_data
-                if data_consumer:
-                    data_consumer(new_data)
-                timeout_count = 0
-            else:
-                timeout_count += 1
-                if timeout is not None and timeout_count >= 100 * timeout:
-                    break
-                time.sleep(0.01)
+        data = self.con.read_until(min_num_bytes, ending, timeout=timeout, data_consumer=data_consumer,
+                                   max_recv=max_recv, keep_data=keep_data)
         logging.debug(f"read until {ending} data: {data}")
         return data
 
@@ -132,35 +439,10 @@ class Pyboard:
         return board_model
 
     def enter_raw_repl(self):
-        # self.con.write(b'\x6D\x70\x79')
+        self._run(self.repl.enter())
 
-        # waiting any board boot start and enter micropython
-        for i in range(8):
-            time.sleep(0.1)
-            self.con.write(b'\x03\x03\x03\x03')
-            time.sleep(0.1)
-            self.con.write(b'\x02\x02\x02\x02')
-            time.sleep(0.1)
-
-            data = self.read_until(1, b'>>>', timeout=5, max_recv=8000)
-            if not data.endswith(b'>>>'):
-                # print(data)
-                print('Could not enter raw repl, Press Reset key after 10 seconds.')
-            else:
-                break
-
-        # flush input (without relying on serial.flushInput())
-        n = self.con.inWaiting()
-        while n > 0:
-            self.con.read(n)
-            n = self.con.inWaiting()
-            
-        # print('enter_raw_repl')
-        self.con.write(b'\r\x01') # ctrl-A: enter raw REPL
-        data = self.read_until(1, b'raw REPL; CTRL-B to exit', max_recv=8000)
-        if not data.endswith(b'raw REPL; CTRL-B to exit'):
-            # print(data)
-            raise PyboardError('could not enter raw repl')
+    def _probe_raw_paste(self):
+        return self._run(self.repl.probe_raw_paste())
 
     def exit_raw_repl(self):
         self.con.write(b'\r\x02')  # ctrl-B: enter friendly REPL
@@ -168,53 +450,39 @@ class Pyboard:
     def keyboard_interrupt(self):
         self.con.write(b'\x03\x03\x03\x03')  # ctrl-C: KeyboardInterrupt
 
-    def follow(self, timeout, data_consumer=None):
+    def follow(self, timeout, data_consumer=None, keep_data=True):
+        return self._run(self.repl.follow(timeout, data_consumer, keep_data))
 
-        # wait for normal output
-        data = self.read_until(1, b'\x04', timeout=timeout, data_consumer=data_consumer)
-        # print(data)
-        if not data.endswith(b'\x04') and not data.endswith(b'>'):
-            raise PyboardError('timeout waiting for first EOF reception')
-        data = data[:-1]
-
-        # wait for error output
-        data_err = self.read_until(1, b'\x04', timeout=timeout)
-        # print(data_err)
-        if not data_err.endswith(b'\x04') and not data.endswith(b'>'):
-            raise PyboardError('timeout waiting for second EOF reception')
-        data_err = data_err[:-1]
-
-        # return normal and error output
-        return data, data_err
+    def raw_paste_write(self, command_bytes):
+        """see RawRepl.raw_paste_write"""
+        self._run(self.repl.raw_paste_write(command_bytes))
 
     def exec_raw_no_follow(self, command):
+        self._run(self.repl.exec_raw_no_follow(command))
 
-        if isinstance(command, bytes):
-            command_bytes = command
-        else:
-            command_bytes = bytes(command.encode('utf-8'))
-
-        # check we have a prompt
-        data = self.read_until(1, b'>')
-
-        if not data.endswith(b'>'):
-            raise PyboardError('could not enter raw repl, auto try again.')
+    def exec_raw(self, command, timeout=4, data_consumer=None):
+        return self._run(self.repl.exec_raw(command, timeout, data_consumer))
 
-        # write command
-        for i in range(0, len(command_bytes), 256):
-            self.con.write(command_bytes[i:min(i + 256, len(command_bytes))])
-            time.sleep(0.01)
-        self.con.write(b'\x04')
+    def exec_stream(self, command, data_consumer, timeout=4):
+        """
+        execute command and hand its output to data_consumer as it arrives, without keeping it in memory
+        Args:
+            command: str/bytes
+            data_consumer: callable, receives bytes (the trailing b'\\x04' included)
 
-        # check if we could exec command
-        data = self.con.read(2)
-        # print(data)
-        if b'OK' not in data:
-            raise PyboardError('could not exec command, auto try again.')
+        Returns:
+            None
 
-    def exec_raw(self, command, timeout=4, data_consumer=None):
+        """
+        logging.debug(f'execute command {command}')
         self.exec_raw_no_follow(command)
-        return self.follow(timeout, data_consumer)
+        ret, ret_err = self.follow(timeout, data_consumer, keep_data=False)
+        if ret_err:
+            raise PyboardError('exception', ret, ret_err)
+
+    def exec_pipelined(self, commands, window=4, timeout=4, on_result=None):
+        """see RawRepl.exec_pipelined"""
+        return self._run(self.repl.exec_pipelined(commands, window, timeout, on_result))
 
     def eval(self, expression):
         ret = self.exec_('print({})'.format(expression))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Transfer agent installed on the board by MpFileExplorer.setup().
+
+Files move in one raw REPL exchange as length-prefixed binary frames over the
+same connection. Every frame sent by the board starts with ACK (b'\\x06'), so
+the host can tell frames from the b'\\x04' that ends the command output.
+
+    put: host  -> <len:2 LE><data>... <0:2>      board -> ACK per frame
+         the top bit of len marks data compressed for _mpf_z (utility/compress.py)
+    get: board -> ACK<size:4 LE>, then ACK<len:2 LE><data>... ACK<0:2> from the offset given
+         host  -> ACK per data frame
+    unpack: host -> records <kind:1><len:2 LE><path>, board -> ACK per record
+         kind D creates the directory path, kind F is followed by the frames of put,
+         kind E ends the archive
+"""
+
+ACK = b'\x06'
+COMPRESSED = 0x8000
+ARCHIVE_DIR = b'D'
+ARCHIVE_FILE = b'F'
+ARCHIVE_END = b'E'
+
+AGENT_SOURCE = """\
+import sys, micropython
+_mpf_i = sys.stdin.buffer
+_mpf_o = sys.stdout.buffer
+def _mpf_rd(n):
+    b = b''
+    while len(b) < n:
+        b += _mpf_i.read(n - len(b))
+    return b
+def _mpf_recv(f):
+    while True:
+        h = _mpf_rd(2)
+        n = h[0] | h[1] << 8
+        if not n:
+            break
+        if n & 0x8000:
+            f.write(_mpf_z(_mpf_rd(n & 0x7fff)))
+        else:
+            f.write(_mpf_rd(n))
+        _mpf_o.write(b'\\x06')
+def _mpf_put(p, m):
+    micropython.kbd_intr(-1)
+    try:
+        with open(p, m) as f:
+            _mpf_recv(f)
+    finally:
+        micropython.kbd_intr(3)
+def _mpf_unpack():
+    try:
+        import uos as os
+    except ImportError:
+        import os
+    micropython.kbd_intr(-1)
+    try:
+        while True:
+            h = _mpf_rd(3)
+            p = _mpf_rd(h[1] | h[2] << 8).decode()
+            if h[0] == 68:
+                try:
+                    os.mkdir(p)
+                except OSError as e:
+                    if e.args[0] != 17:
+                        raise
+                _mpf_o.write(b'\\x06')
+            elif h[0] == 70:
+                with open(p, 'wb') as f:
+                    _mpf_o.write(b'\\x06')
+                    _mpf_recv(f)
+            else:
+                break
+    finally:
+        micropython.kbd_intr(3)
+def _mpf_get(p, n, o):
+    micropython.kbd_intr(-1)
+    try:
+        with open(p, 'rb') as f:
+            s = f.seek(0, 2)
+            f.seek(o)
+            _mpf_o.write(b'\\x06' + bytes((s & 255, s >> 8 & 255, s >> 16 & 255, s >> 24 & 255)))
+            while True:
+                b = f.read(n)
+                _mpf_o.write(b'\\x06' + bytes((len(b) & 255, len(b) >> 8)))
+                if not b:
+                    break
+                _mpf_o.write(b)
+                _mpf_rd(1)
+    finally:
+        micropython.kbd_intr(3)
+"""
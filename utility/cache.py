@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Remote directory listings cached by MpFileExplorerCaching, in memory and between sessions, digests
+of local files cached by MpFileExplorer between sessions, and the boards identified by scan.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import threading
+import time
+from collections import OrderedDict
+
+
+class ListingStore:
+    """
+    directory listings of many boards in one json file, keyed by the device id. The listings of a
+    board are only used while its file system fingerprint is unchanged
+    """
+    MAX_DEVICES = 32  # the least recently used boards are dropped
+    MAX_DIRS = 1024  # listings kept per board, the least recently used are dropped
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def _read(self) -> dict:
+        try:
+            with open(self.file_path, 'r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def load(self, device_id, fingerprint) -> dict:
+        """
+        Args:
+            device_id: str
+            fingerprint: fingerprint of the board file system now
+
+        Returns:
+            {remote dir: [(name, 'D' or 'F')]}, empty if the board changed since the listings were saved
+
+        """
+        entry = self._read().get(device_id)
+        if not entry or entry.get('fingerprint') != fingerprint:
+            logging.info(f'No valid listing cache of {device_id}')
+            return {}
+        listings = {path: [tuple(item) for item in items] for path, items in entry.get('dirs', {}).items()}
+        logging.info(f'Load {len(listings)} cached listings of {device_id}')
+        return listings
+
+    def save(self, device_id, fingerprint, listings: dict) -> None:
+        """
+        Args:
+            device_id: str
+            fingerprint: fingerprint of the board file system the listings belong to
+            listings: {remote dir: [(name, 'D' or 'F')]}, least recently used first
+
+        """
+        data = self._read()
+        data.pop(device_id, None)
+        data[device_id] = {
+            'fingerprint': fingerprint,
+            'used': time.time(),
+            'dirs': {path: [list(item) for item in items]
+                     for path, items in list(listings.items())[-self.MAX_DIRS:]},
+        }
+        if len(data) > self.MAX_DEVICES:
+            recent = sorted(data, key=lambda key: data[key].get('used', 0))[-self.MAX_DEVICES:]
+            data = {key: data[key] for key in recent}
+
+        # sessions of other boards may save at the same time, replace the file in one step
+        tmp_path = f'{self.file_path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_path, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp_path, self.file_path)
+        logging.info(f'Save {len(data[device_id]["dirs"])} listings of {device_id}')
+
+
+class BoardStore:
+    """what scan found out about boards, in one json file keyed by the USB serial number"""
+    MAX_BOARDS = 256  # the least recently seen boards are dropped
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def load(self) -> dict:
+        """
+        Returns:
+            {serial number: {field: value, 'seen': time of the scan}}
+        """
+        try:
+            with open(self.file_path, 'r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def save(self, boards: dict) -> None:
+        """
+        Args:
+            boards: {serial number: {field: value}} found by a scan, merged into the stored ones
+        """
+        data = self.load()
+        now = time.time()
+        for serial_number, fields in boards.items():
+            data.pop(serial_number, None)
+            data[serial_number] = dict(fields, seen=now)
+        if len(data) > self.MAX_BOARDS:
+            recent = sorted(data, key=lambda key: data[key].get('seen', 0))[-self.MAX_BOARDS:]
+            data = {key: data[key] for key in recent}
+
+        tmp_path = f'{self.file_path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_path, 'w') as fp:
+            json.dump(data, fp, indent=1)
+        os.replace(tmp_path, self.file_path)
+        logging.info(f'Save {len(boards)} scanned boards')
+
+
+class DigestCache:
+    """
+    md5 and sha256 of local files in one json file. An entry is used while the (size, mtime_ns, inode)
+    of its file are unchanged, else the file is hashed again block by block
+    """
+    MAX_FILES = 100000  # the least recently used entries are dropped on save
+    BLOCK_SIZE = 64 * 1024
+    RACY_SECONDS = 2  # files modified this recently may change again within the same mtime, not kept
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self._entries = None  # {absolute path: [size, mtime_ns, inode, md5, sha256]}, least recently used first
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    @classmethod
+    def shared(cls, file_path):
+        """one instance per file_path in the process, the sessions of a fleet hash every local file once"""
+        with cls._shared_lock:
+            if file_path not in cls._shared:
+                cls._shared[file_path] = cls(file_path)
+            return cls._shared[file_path]
+
+    def _load(self) -> OrderedDict:
+        with self._lock:
+            return self.__load()
+
+    def __load(self) -> OrderedDict:
+        if self._entries is None:
+            self._entries = OrderedDict()
+            if self.file_path:
+                try:
+                    with open(self.file_path, 'r') as fp:
+                        data = json.load(fp)
+                    if isinstance(data, dict):
+                        self._entries.update(data)
+                except (OSError, ValueError):
+                    pass
+                logging.info(f'Load {len(self._entries)} cached digests')
+        return self._entries
+
+    def digests(self, file_path) -> tuple:
+        """
+        Args:
+            file_path: local file path
+
+        Returns:
+            (md5 hex, sha256 hex) of the file
+
+        """
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        entries = self._load()
+        with self._lock:
+            entry = entries.get(path)
+        if entry is None or entry[:3] != key:
+            entry = key + list(self.hash_file(path))
+            if time.time() - stat.st_mtime < self.RACY_SECONDS:
+                return entry[3], entry[4]
+        with self._lock:
+            if entries.get(path) != entry:
+                self._dirty = True
+            entries.pop(path, None)
+            entries[path] = entry
+        return entry[3], entry[4]
+
+    def md5(self, file_path) -> str:
+        return self.digests(file_path)[0]
+
+    def sha256(self, file_path) -> str:
+        return self.digests(file_path)[1]
+
+    @classmethod
+    def hash_file(cls, file_path) -> tuple:
+        """(md5 hex, sha256 hex) of a file read in BLOCK_SIZE blocks"""
+        md5, sha256 = hashlib.md5(), hashlib.sha256()
+        with open(file_path, 'rb') as fp:
+            for block in iter(lambda: fp.read(cls.BLOCK_SIZE), b''):
+                md5.update(block)
+                sha256.update(block)
+        return md5.hexdigest(), sha256.hexdigest()
+
+    def save(self) -> None:
+        """write the entries to file_path if any was hashed since the last save"""
+        with self._lock:
+            if not self._dirty or not self.file_path:
+                return
+            self._dirty = False
+            entries = list(self._entries.items())[-self.MAX_FILES:]
+        # sessions of other boards may save at the same time, replace the file in one step
+        tmp_path = f'{self.file_path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_path, 'w') as fp:
+            json.dump(OrderedDict(entries), fp)
+        os.replace(tmp_path, self.file_path)
+        logging.info(f'Save {len(entries)} cached digests')
+
+
+class _DirNode:
+    """a remote folder, entries is its listing {name: 'D' or 'F'} or None if not cached"""
+    __slots__ = ('name', 'parent', 'entries', 'children')
+
+    def __init__(self, name='', parent=None):
+        self.name = name
+        self.parent = parent
+        self.entries = None
+        self.children = {}
+
+    @property
+    def path(self):
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(names))
+
+
+class DirCache:
+    """
+    remote folder listings as a tree, so that dropping a folder drops everything cached below it.
+    At most max_dirs listings are kept, the least recently used are evicted first
+    """
+    MAX_DIRS = 1024
+
+    def __init__(self, max_dirs=MAX_DIRS):
+        self.max_dirs = max_dirs
+        self._root = _DirNode()
+        self._lru = OrderedDict()  # path: node with a listing, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _names(path):
+        return [name for name in posixpath.normpath('/' + path).split('/') if name]
+
+    def _node(self, path, create=False):
+        node = self._root
+        for name in self._names(path):
+            child = node.children.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[name] = _DirNode(name, node)
+            node = child
+        return node
+
+    def _forget(self, node):
+        """drop the listings of node and its subtree"""
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.entries is not None:
+                self._lru.pop(current.path, None)
+                current.entries = None
+            stack.extend(current.children.values())
+        node.children = {}
+        self._prune(node)
+
+    @staticmethod
+    def _prune(node):
+        """unlink nodes left without listing and children"""
+        while node.parent is not None and node.entries is None and not node.children:
+            node.parent.children.pop(node.name, None)
+            node = node.parent
+
+    def get(self, path):
+        """
+        Returns:
+            [(name, 'D' or 'F')] of the cached folder path, None if it is not cached
+
+        """
+        node = self._node(path)
+        if node is None or node.entries is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._lru.move_to_end(node.path)
+        return list(node.entries.items())
+
+    def put(self, path, entries):
+        """cache the listing [(name, 'D' or 'F')] of folder path"""
+        node = self._node(path, create=True)
+        node.entries = dict(entries)
+        # sub folders that are gone or turned into files
+        for name in [name for name in node.children if node.entries.get(name) != 'D']:
+            self._forget(node.children[name])
+        self._lru.pop(node.path, None)
+        self._lru[node.path] = node
+        while len(self._lru) > self.max_dirs:
+            _, evicted = self._lru.popitem(last=False)
+            evicted.entries = None
+            self._prune(evicted)
+            self.evictions += 1
+
+    def add(self, path, file_type):
+        """record a new file ('F') or folder ('D') path in the cached listing of its parent"""
+        parent, name = posixpath.split(posixpath.normpath('/' + path))
+        node = self._node(parent)
+        if node is not None and node.entries is not None and name:
+            if node.entries.get(name) != file_type and name in node.children:
+                self._forget(node.children[name])
+            node.entries[name] = file_type
+
+    def remove(self, path):
+        """forget path in the listing of its parent, and everything cached below path"""
+        parent, name = posixpath.split(posixpath.normpath('/' + path))
+        node = self._node(parent)
+        if node is not None and node.entries is not None:
+            node.entries.pop(name, None)
+        self.invalidate(path)
+
+    def invalidate(self, path):
+        """drop the cached listings of folder path and everything below it"""
+        node = self._node(path)
+        if node is not None:
+            self._forget(node)
+
+    def clear(self):
+        self._forget(self._root)
+
+    def listings(self) -> dict:
+        """{path: [(name, 'D' or 'F')]}, least recently used first"""
+        return {path: list(node.entries.items()) for path, node in self._lru.items()}
+
+    def load(self, listings: dict):
+        for path, entries in listings.items():
+            self.put(path, entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'dirs': len(self._lru),
+            'max_dirs': self.max_dirs,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Wire encodings used to move file contents through the raw REPL.
+
+A codec turns a chunk of bytes into a python expression evaluated on the board
+(upload), and tells the board how to print a chunk so the host can decode it
+again (download).
+"""
+
+import binascii
+
+
+class HexCodec:
+    """ubinascii.hexlify/unhexlify, available on every firmware, 100% overhead"""
+    name = 'hex'
+
+    def encode(self, data: bytes) -> str:
+        return "ubinascii.unhexlify('%s')" % binascii.hexlify(data).decode('utf-8')
+
+    @staticmethod
+    def remote_encode(expr: str) -> str:
+        return 'ubinascii.hexlify(%s)' % expr
+
+    @staticmethod
+    def decode(data: bytes) -> bytes:
+        return binascii.unhexlify(data.strip())
+
+    @staticmethod
+    def decoder():
+        return HexDecoder()
+
+
+class Base64Codec:
+    """ubinascii.a2b_base64/b2a_base64, ~33% overhead"""
+    name = 'base64'
+
+    def encode(self, data: bytes) -> str:
+        return "ubinascii.a2b_base64('%s')" % binascii.b2a_base64(data).decode('utf-8').strip()
+
+    @staticmethod
+    def remote_encode(expr: str) -> str:
+        # b2a_base64 ends every chunk with a newline, so chunks can be decoded line by line
+        return 'ubinascii.b2a_base64(%s)' % expr
+
+    @staticmethod
+    def decode(data: bytes) -> bytes:
+        return b''.join(binascii.a2b_base64(line) for line in data.split(b'\n') if line.strip())
+
+    @staticmethod
+    def decoder():
+        return Base64Decoder()
+
+
+class BytesCodec:
+    """escaped bytes literal, needs no module on the board. Upload only"""
+    name = 'bytes'
+
+    def encode(self, data: bytes) -> str:
+        return repr(bytes(data))
+
+
+class AutoCodec:
+    """pick the shortest encoding among the candidates for every chunk"""
+
+    def __init__(self, codecs):
+        self.codecs = codecs
+        self.name = '/'.join(codec.name for codec in codecs)
+
+    def encode(self, data: bytes) -> str:
+        return min((codec.encode(data) for codec in self.codecs), key=len)
+
+
+class HexDecoder:
+    """incremental decoder for a hex stream"""
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, data: bytes) -> bytes:
+        data = self._pending + bytes(data).translate(None, b'\r\n\x04')
+        size = len(data) - len(data) % 2
+        self._pending = data[size:]
+        return binascii.unhexlify(data[:size])
+
+    def flush(self) -> bytes:
+        if self._pending:
+            raise ValueError('truncated hex data')
+        return b''
+
+
+class Base64Decoder:
+    """incremental decoder for a stream of base64 lines"""
+
+    def __init__(self):
+        self._pending = bytearray()
+
+    def feed(self, data: bytes) -> bytes:
+        self._pending += bytes(data).translate(None, b'\x04')
+        if b'\n' not in data:
+            return b''
+        lines = self._pending.split(b'\n')
+        self._pending = lines.pop()
+        return b''.join(binascii.a2b_base64(line) for line in lines if line.strip())
+
+    def flush(self) -> bytes:
+        data, self._pending = self._pending, bytearray()
+        return binascii.a2b_base64(data) if data.strip() else b''
+
+
+CODECS = {
+    HexCodec.name: HexCodec(),
+    Base64Codec.name: Base64Codec(),
+    BytesCodec.name: BytesCodec(),
+}
+
+
+def select_codecs(has_base64: bool):
+    """
+    Choose the codecs for a session from what the firmware supports
+    Args:
+        has_base64: ubinascii provides a2b_base64/b2a_base64
+
+    Returns:
+        (write codec, read codec)
+
+    """
+    if has_base64:
+        return AutoCodec([CODECS['base64'], CODECS['bytes']]), CODECS['base64']
+    return AutoCodec([CODECS['hex'], CODECS['bytes']]), CODECS['hex']
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Deflate compression of uploads, decompressed on the board before the chunk is written.
+"""
+
+import zlib
+from pathlib import Path
+
+# defines _mpf_z(bytes) -> bytes on the board with whichever decompressor the firmware has
+DECOMPRESSOR_SOURCE = """\
+try:
+    import deflate, io
+    def _mpf_z(b):
+        return deflate.DeflateIO(io.BytesIO(b), deflate.ZLIB).read()
+except ImportError:
+    try:
+        import zlib
+        zlib.decompress
+        def _mpf_z(b):
+            return zlib.decompress(b)
+    except (ImportError, AttributeError):
+        import uzlib
+        def _mpf_z(b):
+            return uzlib.decompress(b)
+"""
+
+# already compressed or binary formats, not worth a try
+INCOMPRESSIBLE_SUFFIXES = ('.mpy', '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.mp3', '.wav', '.amr',
+                           '.gz', '.zip', '.tar', '.bin')
+MIN_SIZE = 512  # smaller files gain less than the decompress call costs
+SAMPLE_SIZE = 4096
+MAX_RATIO = 0.9
+WBITS = 10  # 1KB window, keeps the decompressor small on the board
+
+
+def compress_chunk(data: bytes):
+    """
+    Compress one chunk as an independent zlib stream
+    Args:
+        data: bytes
+
+    Returns:
+        compressed bytes, or None if it is not smaller than data
+
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, WBITS)
+    ret = compressor.compress(data) + compressor.flush()
+    if len(ret) >= len(data):
+        return None
+    return ret
+
+
+def should_compress(file_path, data: bytes) -> bool:
+    """
+    Decide by suffix, size and a trial compression of the head of data
+    Args:
+        file_path: str/Path, local file path
+        data: file content
+
+    Returns:
+        bool
+
+    """
+    if Path(file_path).suffix.lower() in INCOMPRESSIBLE_SUFFIXES or len(data) < MIN_SIZE:
+        return False
+    sample = data[:SAMPLE_SIZE]
+    ret = compress_chunk(sample)
+    return ret is not None and len(ret) < len(sample) * MAX_RATIO
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Block level delta uploads: the board hashes fixed-size blocks of the existing
+file with _mpf_blocks (utility/hashing.py), the host sends only the blocks that differ.
+"""
+
+import hashlib
+
+from utility.hashing import BLOCK_DIGEST_SIZE
+
+BLOCK_SIZE = 1024
+
+
+def block_digests(data: bytes, block_size=BLOCK_SIZE):
+    return [hashlib.sha256(data[i:i + block_size]).hexdigest()[:BLOCK_DIGEST_SIZE * 2]
+            for i in range(0, len(data), block_size)]
+
+
+def parse_remote_blocks(output: bytes):
+    """
+    Parse the output of _mpf_blocks
+    Returns:
+        (remote file size, list of block digests), size is -1 if the file does not exist
+
+    """
+    lines = output.decode('utf-8').split()
+    return int(lines[0]), lines[1:]
+
+
+def changed_runs(data: bytes, remote_size: int, remote_digests, block_size=BLOCK_SIZE):
+    """
+    Work out which parts of data differ from the remote file
+    Args:
+        data: new content
+        remote_size: size of the remote file
+        remote_digests: block digests of the remote file
+
+    Returns:
+        list of (offset, length), consecutive changed blocks merged into one run.
+        None if the remote file cannot be patched in place (missing or longer than data)
+
+    """
+    if remote_size < 0 or remote_size > len(data):
+        return None
+    runs = []
+    for index, digest in enumerate(block_digests(data, block_size)):
+        if index < len(remote_digests) and remote_digests[index] == digest:
+            continue
+        offset = index * block_size
+        length = min(block_size, len(data) - offset)
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1] = (runs[-1][0], runs[-1][1] + length)
+        else:
+            runs.append((offset, length))
+    return runs
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import binascii
+import ast
 import hashlib
 import logging
 import os
@@ -12,31 +12,144 @@ def init_log_path(file_path='log'):
     return os.path.join(file_path, file_name)
 
 
+def init_home_path(dir_name='.mpfshell'):
+    """folder in the user home for the data kept between sessions"""
+    home_path = os.path.join(os.path.expanduser('~'), dir_name)
+    os.makedirs(home_path, exist_ok=True)
+    return home_path
+
+
 class MD5Varifier:
-    _cache = {}
+    """
+    signs of the files put on the board, kept in cache_file on the board.
+
+    cache_file is a text file of CRLF terminated lines: the header SIGN_HEADER, then one
+    '<md5 hex> <path>' line per file. A change is appended as another line, the last line of a path
+    wins and '- <path>' removes it, so the file is rewritten only to compact it. Files of the old
+    format, one dict literal per line, are read with ast.literal_eval and rewritten in the new one
+    """
     cache_file = '/sign'  # 板子的顶级目录
+    SIGN_HEADER = '#mpfsign 2'
+    REMOVED = '-'
+    COMPACT_MIN = 64  # appended lines always tolerated before a rewrite of cache_file
 
-    def __init__(self, cache_file=None):
+    def __init__(self, cache_file=None, digest_cache=None):
         logging.info('Init MD5Varifier')
         if cache_file is not None:
             self._cache_file = cache_file
+        self.digest_cache = digest_cache  # utility.cache.DigestCache of the local files, if any
+        self._cache = {}  # {remote path: md5 hex} of this board only
+        self._pending = {}  # {remote path: md5 hex} of files picked for upload and not written yet
+        self._batch_depth = 0
+        self._batch_changed = False
+        self.appendable = False  # cache_file on the board is in the current format
+        self.appended = 0  # lines appended to cache_file since it was last written whole
+
+    def begin(self):
+        """start a batch, batches nest and only the outermost commit counts"""
+        self._batch_depth += 1
+
+    def commit(self):
+        """
+        end a batch
+        Returns:
+            bytes of the sign file to write if the outermost batch changed signs and the file
+            can't take them as appended lines, else False
+
+        """
+        self._batch_depth -= 1
+        if self._batch_depth > 0 or not self._batch_changed:
+            return False
+        self._batch_changed = False
+        if self.appendable and not self.needs_compaction:
+            return False
+        return self._update_cache_file()
+
+    @property
+    def in_batch(self):
+        return self._batch_depth > 0
+
+    @property
+    def needs_compaction(self):
+        return self.appended > max(self.COMPACT_MIN, len(self._cache))
+
+    def append_lines(self, file_paths_remote):
+        """
+        lines to append to cache_file for the current signs of file_paths_remote
+        Args:
+            file_paths_remote: iterable of str
+
+        Returns:
+            bytes, False if cache_file has to be written whole instead
+
+        """
+        file_paths_remote = list(file_paths_remote)
+        if not self.appendable or self.cache_file in file_paths_remote:
+            return False
+        self.appended += len(file_paths_remote)
+        return ''.join(self._sign_line(path, self._cache.get(path)) for path in file_paths_remote).encode('utf-8')
+
+    def written(self):
+        """cache_file on the board was just written whole from _update_cache_file"""
+        self.appendable = True
+        self.appended = 0
+
+    def _sign_line(self, file_path, sign):
+        return f'{sign or self.REMOVED} {file_path}\r\n'
+
+    def _changed(self):
+        if self.in_batch:
+            self._batch_changed = True
 
     def init_cache(self, cache_data: bytes):
         """
         Get MD5 signatures from cache_data, and store to self._cache
         Args:
-            cache_data: read result of cache_file
+            cache_data: content of cache_file
 
         Returns:
 
         """
-        if cache_data == b'' or cache_data == b'0d0a':
-            return
-        file_info = binascii.a2b_hex(cache_data).decode('utf-8')  # 字符串
+        self._cache = {}
+        self._pending = {}
+        self.appendable = False
+        self.appended = 0
+        lines = cache_data.decode('utf-8').split('\n')
+        if lines[0].rstrip('\r') == self.SIGN_HEADER:
+            self._parse_lines(lines[1:])
+            # a cut short last line would swallow the next appended one
+            self.appendable = cache_data.endswith(b'\n')
+        elif cache_data.strip():
+            logging.info(f'{self.cache_file} is in the old format, migrate it')
+            self._parse_old_lines(lines)
 
-        for line_ in file_info.strip().split('\r\n'):
+    def _parse_lines(self, lines):
+        for line_ in lines:
+            sign, _, file_path = line_.rstrip('\r').partition(' ')
+            if not file_path:
+                continue
+            if sign == self.REMOVED:
+                self._cache.pop(file_path, None)
+            elif len(sign) == 32:
+                self._cache[file_path] = sign
+            else:
+                # an append cut short when the board lost power
+                logging.warning(f'skip broken sign line: {line_!r}')
+            self.appended += 1
+        self.appended -= len(self._cache)
+
+    def _parse_old_lines(self, lines):
+        for line_ in lines:
+            line_ = line_.strip()
             if line_:
-                self._cache.update(eval(line_))
+                self._cache.update(ast.literal_eval(line_))
+        # entries of removed files
+        for file_path in [file_path for file_path, sign in self._cache.items() if sign is None]:
+            self._cache.pop(file_path)
+
+    @property
+    def needs_migration(self):
+        return not self.appendable and bool(self._cache)
 
     def _update_cache_file(self) -> bytes:
         """
@@ -45,10 +158,9 @@ class MD5Varifier:
             bytes
 
         """
-        cache_list = [str({_k:_v}) for _k, _v in self._cache.items()]
-        cache_str = '\r\n'.join(cache_list)
-        cache_str += '\r\n'
-        return cache_str.encode('utf-8')
+        cache_list = [self.SIGN_HEADER + '\r\n']
+        cache_list.extend(self._sign_line(_k, _v) for _k, _v in self._cache.items())
+        return ''.join(cache_list).encode('utf-8')
 
     @staticmethod
     def md5_sign(file_obj):
@@ -65,6 +177,25 @@ class MD5Varifier:
         tool.update(file_obj)
         return tool.hexdigest()
 
+    def file_sign(self, file_path):
+        """
+        signature of a local file, from digest_cache if its stat is unchanged
+        Args:
+            file_path:
+            str/pathlib.Path()
+
+        Returns:
+            md5 hex
+
+        """
+        if self.digest_cache is not None:
+            return self.digest_cache.md5(file_path)
+        tool = hashlib.md5()
+        with open(file_path, 'rb') as fp:
+            for block in iter(lambda: fp.read(64 * 1024), b''):
+                tool.update(block)
+        return tool.hexdigest()
+
     def gen_sign(self, file_path):
         """
         Generate signature of file_path
@@ -75,8 +206,7 @@ class MD5Varifier:
         Returns:
 
         """
-        with open(file_path, 'rb') as fp:
-            sign = self.md5_sign(fp.read())
+        sign = self.file_sign(file_path)
         self._cache.update({file_path: sign})
         logging.info(f'add sign: {file_path}:{sign}')
         return self._update_cache_file()
@@ -90,44 +220,86 @@ class MD5Varifier:
             verbose: if print detail info
 
         Returns:
+            True if the sign changed. The new sign stays pending until accept_signs is called for the
+            written file, so the sign file never lists a file that is not on the board yet
 
         """
         logging.info(f'varify file: {file_path}[local] -- {file_path_remote}[remote]')
-        with open(file_path, 'rb') as fp:
-            sign = self.md5_sign(fp.read())
+        sign = self.file_sign(file_path)
+        self._pending.pop(file_path_remote, None)
         if not self._cache.get(file_path_remote):  # first upload
             logging.info(f'{file_path_remote}: There is no signatures before')
-            self._cache.update({file_path_remote: sign})
+            self._pending[file_path_remote] = sign
             if verbose:
                 print(f' * add {file_path_remote}')
-            return self._update_cache_file()
+            return True
         sign_ori = self._cache.get(file_path_remote)
         if sign_ori != sign:  # update
             logging.info('The old and new signatures are inconsistent, update')
-            self._cache.update({file_path_remote: sign})
+            self._pending[file_path_remote] = sign
             if verbose:
                 print(f' * update {file_path_remote}')
-            return self._update_cache_file()
+            return True
         else:
             logging.info('The new signatures is same as the old, don`t updte')
             return False
 
-    def rm_sign(self, file_path_remote) -> bytes:
+    def accept_signs(self, file_paths_remote) -> list:
+        """
+        the files were written, their pending signs from varify_sign become current
+        Args:
+            file_paths_remote: iterable of str
+
+        Returns:
+            the paths whose sign changed, to be recorded in cache_file
+
+        """
+        accepted = [path for path in file_paths_remote if path in self._pending]
+        for path in accepted:
+            self._cache[path] = self._pending.pop(path)
+        if accepted:
+            self._changed()
+        return accepted
+
+    def rm_sign(self, file_path_remote) -> bool:
         """
         update sign after remove file
         Args:
             file_path_remote: str
 
         Returns:
+            True
 
         """
         logging.info(f'remove sign of {file_path_remote}')
+        self._pending.pop(file_path_remote, None)
         if file_path_remote == self.cache_file:
             self._cache = {}
         else:
             if file_path_remote in self._cache:
                 self._cache.pop(file_path_remote)
-        return self._update_cache_file()
+        self._changed()
+        return True
+
+    def rm_signs(self, file_paths_remote):
+        """
+        update sign after removing many files
+        Args:
+            file_paths_remote: iterable of str
+
+        Returns:
+            True, False if none of the files had a sign
+
+        """
+        file_paths_remote = list(file_paths_remote)
+        for path in file_paths_remote:
+            self._pending.pop(path, None)
+        removed = [path for path in file_paths_remote if self._cache.pop(path, None) is not None]
+        if not removed:
+            return False
+        self._changed()
+        logging.info(f'remove sign of {len(removed)} files')
+        return True
 
     def get_filename_by_suffix(self, filename_suffix):
         files = [filename for filename, sign in self._cache.items()
@@ -145,8 +317,4 @@ def get_file_size(file_path):
         size of bytes
 
     """
-    try:
-        with open(file_path, 'rb') as fp:
-            return len(fp.read())
-    except Exception as e:
-        raise e
\ No newline at end of file
+    return os.stat(file_path).st_size
\ No newline at end of file
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Hash helpers defined on the board by MpFileExplorer.setup(), they need hashlib.sha256.
+"""
+
+import hashlib
+
+BLOCK_DIGEST_SIZE = 8  # leading bytes of the sha256 of a block
+HASH_READ_SIZE = 1024
+
+# _mpf_sha(path) prints the sha256 of a file, '-' if it does not exist
+# _mpf_shas(paths) prints '<sha256> <path>' for each path, '-' for the digest if it does not exist
+# _mpf_blocks(path, block_size) prints the file size and one digest per block, -1 if it does not exist
+HASH_SOURCE = """\
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+hashlib.sha256
+def _mpf_hash(p):
+    try:
+        f = open(p, 'rb')
+    except OSError:
+        return '-'
+    h = hashlib.sha256()
+    with f:
+        while True:
+            b = f.read(%d)
+            if not b:
+                break
+            h.update(b)
+    return ubinascii.hexlify(h.digest()).decode()
+def _mpf_sha(p):
+    print(_mpf_hash(p))
+def _mpf_shas(ps):
+    for p in ps:
+        print(_mpf_hash(p), p)
+def _mpf_blocks(p, n):
+    try:
+        f = open(p, 'rb')
+    except OSError:
+        print(-1)
+        return
+    with f:
+        print(f.seek(0, 2))
+        f.seek(0)
+        while True:
+            b = f.read(n)
+            if not b:
+                break
+            print(ubinascii.hexlify(hashlib.sha256(b).digest()[:%d]).decode())
+""" % (HASH_READ_SIZE, BLOCK_DIGEST_SIZE)
+
+
+def sha256_file(file_path, block_size=64 * 1024):
+    """
+    sha256 of a local file, read block by block
+    """
+    tool = hashlib.sha256()
+    with open(file_path, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            tool.update(block)
+    return tool.hexdigest()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Directory listing and removal helpers defined on the board by MpFileExplorer.setup().
+"""
+
+# _mpf_ls(path) prints one '<D|F> <size> <name>' line per entry. The type and size come from
+# ilistdir, entries it cannot describe are stat()ed on the board, so a listing is one round trip
+# _mpf_walk(path) prints one '<D|F> <size> <mtime> <path>' line for path and every node below it,
+# every folder before its content. It keeps its own stack, deep trees do not hit the recursion limit
+# _mpf_rmrf(path) removes path and everything below it, printing '<D|F> <path>' for every node removed
+LIST_SOURCE = """\
+def _mpf_ls(p):
+    try:
+        import uos as os
+    except ImportError:
+        import os
+    if hasattr(os, 'ilistdir'):
+        l = os.ilistdir(p)
+    else:
+        l = ((n, 0) for n in os.listdir(p))
+    for e in l:
+        t = e[1]
+        s = e[3] if len(e) > 3 else -1
+        if not t or (t != 0x4000 and s < 0):
+            st = os.stat(p.rstrip('/') + '/' + e[0])
+            t, s = st[0] & 0xc000, st[6]
+        if t == 0x4000:
+            print('D', 0, e[0])
+        else:
+            print('F', s, e[0])
+def _mpf_walk(p):
+    try:
+        import uos as os
+    except ImportError:
+        import os
+    l = [(p, os.stat(p))]
+    while l:
+        p, st = l.pop()
+        if st[0] & 0x4000:
+            print('D', 0, st[8], p)
+            b = p.rstrip('/') + '/'
+            for n in os.listdir(p):
+                l.append((b + n, os.stat(b + n)))
+        else:
+            print('F', st[6], st[8], p)
+def _mpf_rmrf(p):
+    try:
+        import uos as os
+    except ImportError:
+        import os
+    l = [p]
+    d = []
+    while l:
+        p = l.pop()
+        if os.stat(p)[0] & 0x4000:
+            d.append(p)
+            b = p.rstrip('/') + '/'
+            l.extend(b + n for n in os.listdir(p))
+        else:
+            os.remove(p)
+            print('F', p)
+    while d:
+        p = d.pop()
+        os.rmdir(p)
+        print('D', p)
+"""
+
+
+def parse_listing(output: bytes):
+    """
+    Parse the output of _mpf_ls
+    Args:
+        output: bytes printed by _mpf_ls
+
+    Returns:
+        [(name, 'D' or 'F', size)]
+
+    """
+    entries = []
+    for line in output.decode('utf-8').splitlines():
+        parts = line.strip('\r').split(' ', 2)
+        if len(parts) == 3 and parts[0] in ('D', 'F') and parts[1].lstrip('-').isdigit():
+            entries.append((parts[2], parts[0], int(parts[1])))
+    return entries
+
+
+def parse_walk_line(line: bytes):
+    """
+    Parse a line printed by _mpf_walk
+    Args:
+        line: bytes
+
+    Returns:
+        (path, 'D' or 'F', size, mtime), None for anything else
+
+    """
+    parts = line.decode('utf-8').strip('\r\n\x04').split(' ', 3)
+    if len(parts) != 4 or parts[0] not in ('D', 'F') or not parts[1].isdigit() \
+            or not parts[2].lstrip('-').isdigit():
+        return None
+    return parts[3], parts[0], int(parts[1]), int(parts[2])
+
+
+def parse_removed(output: bytes):
+    """
+    Parse the output of _mpf_rmrf
+    Args:
+        output: bytes printed by _mpf_rmrf
+
+    Returns:
+        [(path, 'D' or 'F')] in the order they were removed
+
+    """
+    removed = []
+    for line in output.decode('utf-8').splitlines():
+        parts = line.strip('\r\x04').split(' ', 1)
+        if len(parts) == 2 and parts[0] in ('D', 'F'):
+            removed.append((parts[1], parts[0]))
+    return removed
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Local preparation of uploads ahead of the transport. Worker threads read, hash and compress the
+next files while the current one is on the wire, a bounded queue limits how many wait in memory.
+"""
+
+import hashlib
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utility.compress import compress_chunk, should_compress
+
+
+class PreparedFile:
+    """a local file ready to send, chunks maps every chunk of data at chunk_size to its compressed form"""
+    __slots__ = ('local', 'remote', 'data', 'digest', 'compress', 'chunks')
+
+    def __init__(self, local, remote, data, digest, compress, chunks):
+        self.local = local
+        self.remote = remote
+        self.data = data
+        self.digest = digest
+        self.compress = compress
+        self.chunks = chunks
+
+
+def prepare_file(local, remote, chunk_size, compress=True) -> PreparedFile:
+    """
+    Args:
+        local: local file path
+        remote: remote file path
+        chunk_size: chunk size of the transport, chunks are compressed in advance at this size
+        compress: the board can decompress
+
+    Returns:
+        PreparedFile
+
+    """
+    with open(local, 'rb') as fp:
+        data = fp.read()
+    compress = compress and should_compress(local, data)
+    chunks = {}
+    if compress:
+        for offset in range(0, len(data), chunk_size):
+            chunk = data[offset:offset + chunk_size]
+            chunks[chunk] = compress_chunk(chunk)
+    return PreparedFile(local, remote, data, hashlib.sha256(data).hexdigest(), compress, chunks)
+
+
+class PreparePipeline:
+    """
+    iterate prepared files in their order. A feeder thread submits them to a pool of workers and
+    queues the pending results, at most depth of them, so that preparation stays a few files ahead
+
+    stats tell the bottleneck: the transport stalls waiting for a file when the host is too slow,
+    the feeder blocks on the full queue when the link is
+    """
+    WORKERS = 2
+    DEPTH = 4
+
+    def __init__(self, items, prepare, workers=None, depth=None):
+        """
+        Args:
+            items: arguments of prepare, one tuple per file
+            prepare: callable(*item) run in a worker thread
+        """
+        self._items = list(items)
+        self._prepare = prepare
+        self._workers = workers or self.WORKERS
+        self._depth = depth or self.DEPTH
+        self._queue = queue.Queue(maxsize=self._depth)
+        self._stop = threading.Event()
+        self.stall_time = 0.0  # the transport waited for a file
+        self.feed_time = 0.0  # the feeder waited for room in the queue
+        self._depths = []
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=self._workers)
+        feeder = threading.Thread(target=self._feed, args=(executor,), name='mpf-prepare', daemon=True)
+        feeder.start()
+        try:
+            for _ in self._items:
+                self._depths.append(self._queue.qsize())
+                start = time.time()
+                future = self._queue.get()
+                prepared = future.result()
+                self.stall_time += time.time() - start
+                yield prepared
+        finally:
+            self._stop.set()
+            # unblock the feeder if the transport stopped early
+            while feeder.is_alive():
+                try:
+                    self._queue.get(timeout=0.1).cancel()
+                except queue.Empty:
+                    pass
+            executor.shutdown(wait=True)
+            logging.info(f'prepare pipeline: {self.report()}')
+
+    def _feed(self, executor):
+        for item in self._items:
+            if self._stop.is_set():
+                return
+            future = executor.submit(self._prepare, *item)
+            start = time.time()
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(future, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self.feed_time += time.time() - start
+
+    def stats(self) -> dict:
+        return {
+            'files': len(self._depths),
+            'depth': self._depth,
+            'mean_depth': sum(self._depths) / len(self._depths) if self._depths else 0.0,
+            'stall_time': self.stall_time,
+            'feed_time': self.feed_time,
+        }
+
+    def report(self) -> str:
+        stats = self.stats()
+        bound = 'host' if stats['stall_time'] > stats['feed_time'] else 'link'
+        return ('%(files)d files, queue depth %(mean_depth).1f/%(depth)d, transport stalled %(stall_time).2fs, '
+                'preparation blocked %(feed_time).2fs' % stats) + f', {bound} bound'
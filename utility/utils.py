@@ -34,3 +34,132 @@ def trim_code_block(code_block):
 
         return ''.join(lines)
     return code_block
+
+
+class ChunkSizer:
+    """
+    Chunk size of file transfers. The upper bound comes from the free RAM of the board,
+    the first chunks of every transfer are timed to grow or shrink the size.
+    """
+    MIN_SIZE = 256
+    MAX_SIZE = 16 * 1024
+    TARGET_TIME = 0.5  # seconds for one chunk
+    PROBE_CHUNKS = 4  # chunks timed at the start of every transfer
+
+    def __init__(self, size, mem_free=None):
+        self.upper = self.MAX_SIZE
+        if mem_free:
+            # the board holds the encoded command, the decoded chunk and the compiled code at once
+            self.upper = max(self.MIN_SIZE, min(self.MAX_SIZE, mem_free // 8))
+        self.size = self._bound(size)
+        self._probes = 0
+
+    def _bound(self, size):
+        return max(self.MIN_SIZE, min(self.upper, int(size)))
+
+    def start(self):
+        """
+        begin a transfer
+        Returns:
+            chunk size for the transfer
+        """
+        self._probes = 0
+        return self.size
+
+    def record(self, nbytes, seconds):
+        """
+        time of one chunk of nbytes, adjust the size while probing
+        """
+        if self._probes >= self.PROBE_CHUNKS or nbytes < self.size:
+            return
+        self._probes += 1
+        if seconds < self.TARGET_TIME / 2:
+            self.size = self._bound(self.size * 2)
+        elif seconds > self.TARGET_TIME * 2:
+            self.size = self._bound(self.size // 2)
+
+    def memory_error(self):
+        """
+        the board ran out of memory for a chunk, lower the size and its upper bound
+        Returns:
+            False if the size is already the minimum
+        """
+        if self.size <= self.MIN_SIZE:
+            return False
+        self.size = self._bound(self.size // 2)
+        self.upper = self.size
+        return True
+
+
+class RingBuffer:
+    """
+    Fixed size byte FIFO in a preallocated bytearray, not thread safe. Offsets of find, peek and take
+    count from the oldest byte.
+    """
+
+    def __init__(self, capacity):
+        self._buf = bytearray(capacity)
+        self._capacity = capacity
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def free(self):
+        return self._capacity - self._size
+
+    def clear(self):
+        self._start = self._size = 0
+
+    def write(self, data) -> int:
+        """append as much of data as fits, returns the number of bytes appended"""
+        n = min(len(data), self.free)
+        end = (self._start + self._size) % self._capacity
+        first = min(n, self._capacity - end)
+        self._buf[end:end + first] = data[:first]
+        self._buf[:n - first] = data[first:n]
+        self._size += n
+        return n
+
+    def peek(self, lo, hi) -> bytes:
+        hi = min(hi, self._size)
+        if lo >= hi:
+            return b''
+        lo += self._start
+        hi += self._start
+        if hi <= self._capacity:
+            return bytes(self._buf[lo:hi])
+        if lo >= self._capacity:
+            return bytes(self._buf[lo - self._capacity:hi - self._capacity])
+        return bytes(self._buf[lo:]) + bytes(self._buf[:hi - self._capacity])
+
+    def take(self, n) -> bytes:
+        data = self.peek(0, n)
+        self._start = (self._start + len(data)) % self._capacity
+        self._size -= len(data)
+        if not self._size:
+            self._start = 0
+        return data
+
+    def find(self, sub, start=0) -> int:
+        """offset of the first sub at or after start, -1 if there is none"""
+        tail = self._start + self._size
+        if tail <= self._capacity:
+            index = self._buf.find(sub, self._start + start, tail)
+            return index - self._start if index >= 0 else -1
+
+        first = self._capacity - self._start  # bytes before the wrap
+        if start < first:
+            index = self._buf.find(sub, self._start + start, self._capacity)
+            if index >= 0:
+                return index - self._start
+            # matches crossing the wrap
+            lo = max(start, first - len(sub) + 1)
+            index = self.peek(lo, first + len(sub) - 1).find(sub)
+            if index >= 0:
+                return lo + index
+            start = first
+        index = self._buf.find(sub, start - first, tail - self._capacity)
+        return index + first if index >= 0 else -1